@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+
+# modules a fit-only worker imports, and dependencies they must not pull in at import time
+MODULES = ['components', 'task', 'profiles', 'photometry', 'mge',
+           'multiband', 'grid_search', 'montecarlo', 'tiling',
+           'campaign', 'staging', 'cost_model', 'memory_budget', 'sky_estimate',
+           'sqlite_store', 'header_index', 'psf_library', 'fit_log',
+           'fit_result', 'residual_stats', 'subcomponents', 'compact',
+           'display', 'plot_fig']
+HEAVY = ['astropy', 'scipy', 'matplotlib', 'photutils']
+
+__probe__ = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = sorted(m for m in {heavy} if m in sys.modules)
+print(elapsed, ','.join(heavy))
+'''
+
+
+def import_time(module, repeat=5):
+    """
+    Import a module in fresh interpreters
+    :param module: str, module name
+    :param repeat: int, number of interpreters, the fastest is kept
+    :return: (float, list of str), import time [s] and heavy dependencies found in sys.modules
+    """
+    best, heavy = None, []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', __probe__.format(module=module, heavy=HEAVY)],
+                                check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        elapsed = float(output[0])
+        heavy = output[1].split(',') if len(output) > 1 else []
+        best = elapsed if best is None else min(best, elapsed)
+    return best, heavy
+
+
+if __name__ == '__main__':
+    failed = False
+    for module in MODULES:
+        elapsed, heavy = import_time(module)
+        print(f'{module:12s} {elapsed * 1000:8.1f} ms  {" ".join(heavy)}')
+        failed |= len(heavy) > 0
+    if failed:
+        sys.exit('heavy dependencies are imported eagerly')
@@ -0,0 +1,51 @@
+import os
+import sys
+import tempfile
+import time
+from task import *
+
+SIZES = [1000, 10000, 100000]
+
+__config__ = {'A': 'image.fits', 'B': 'image_out.fits', 'C': 'none', 'D': 'psf.fits', 'E': 1,
+              'F': 'none', 'G': 'none', 'H': '1 4096 1 4096', 'I': '64 64', 'J': 25.0,
+              'K': '0.4 0.4', 'O': 'regular', 'P': 0}
+
+
+def crowded_task(n_components):
+    """
+    Task with n_components PSF and Sersic components, built without touching any FITS file
+    """
+    task = GalfitTask(Config.from_dict(__config__))
+    for i in range(n_components):
+        component = PSF() if i % 2 else Sersic()
+        component.set_position(i % 4096 + 0.5, i // 4096 + 0.5)
+        component.set_magnitude(20 + i % 7)
+        task.add_component(component)
+    return task
+
+
+def write_time(task, repeat=3):
+    """
+    :return: float, fastest time [s] to write the parameter file
+    """
+    best = None
+    with tempfile.TemporaryDirectory() as tmp:
+        galfit_file = os.path.join(tmp, 'crowded.galfit')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with open(galfit_file, 'w', buffering=1 << 20) as file:
+                task.write(file)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    per_component = []
+    for n in SIZES:
+        elapsed = write_time(crowded_task(n))
+        per_component.append(elapsed / n)
+        print(f'{n:8d} components {elapsed * 1000:9.1f} ms  {elapsed / n * 1e6:6.2f} us/component')
+    # linear scaling: the cost per component must not grow with the number of components
+    if per_component[-1] > 3 * per_component[0]:
+        sys.exit('writing the parameter file does not scale linearly')
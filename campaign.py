@@ -0,0 +1,228 @@
+import copy
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from task import *
+from sqlite_store import SQLiteStore
+
+__schema__ = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    galfit_file TEXT NOT NULL,
+    output_file TEXT,
+    restart_file TEXT,
+    parameters TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    priority REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    submitted REAL,
+    started REAL,
+    heartbeat REAL,
+    finished REAL,
+    duration REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, id);
+CREATE INDEX IF NOT EXISTS jobs_output ON jobs (output_file);
+'''
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class Campaign(SQLiteStore):
+    def __init__(self, db_file, timeout=60):
+        """
+        Job store of GalfitTasks backed by a SQLite file
+        Several processes, also on different nodes sharing the file system, may use the same file.
+        The database uses the default rollback journal since WAL does not work on network file systems.
+        :param db_file, timeout: see SQLiteStore
+        """
+        SQLiteStore.__init__(self, db_file, __schema__, timeout, isolation_level=None)
+
+    def __transaction__(self, statements):
+        # BEGIN IMMEDIATE takes the write lock up front, so claims never race
+        cursor = self.__connection__.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            result = statements(cursor)
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        return result
+
+    def add_task(self, task: GalfitTask, galfit_file=None, name=None, priority=0):
+        """
+        Record a task as a pending job
+        :param task: GalfitTask, rendered now with absolute paths, later changes to the task are not seen by the job
+        :param galfit_file: str, parameter file written by the worker, defaults to the output with .galfit
+        :param name: str, free label, e.g. the galaxy name
+        :param priority: float, jobs with higher priority are claimed first
+        :return: int, job id
+        """
+        return self.add_tasks([task], [galfit_file], [name], [priority])[0]
+
+    def add_tasks(self, tasks, galfit_files=None, names=None, priorities=None):
+        """
+        Record many tasks in a single transaction, see add_task
+        :return: list of int, job ids
+        """
+        tasks = list(tasks)
+        galfit_files = galfit_files or [None] * len(tasks)
+        names = names or [None] * len(tasks)
+        priorities = priorities or [0] * len(tasks)
+        now = time.time()
+        rows = []
+        for task, galfit_file, name, priority in zip(tasks, galfit_files, names, priorities):
+            # workers run GALFIT in a temporary directory, so the stored paths must be absolute
+            task = copy.deepcopy(task)
+            task.config.abspath()
+            output_file = task.config.output_file
+            if galfit_file is None:
+                galfit_file = output_file.replace('.fits', '.galfit')
+            rows.append((name, os.path.abspath(galfit_file), output_file, task.__repr__(), priority, now))
+
+        def insert(cursor):
+            ids = []
+            for row in rows:
+                cursor.execute('INSERT INTO jobs (name, galfit_file, output_file, parameters, priority, submitted) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', row)
+                ids.append(cursor.lastrowid)
+            return ids
+        return self.__transaction__(insert)
+
+    def claim(self, worker=None, lease=600, max_attempts=3):
+        """
+        Atomically take the next pending job
+        Running jobs whose heartbeat is older than lease seconds are considered lost and claimed again.
+        :param worker: str, worker label, defaults to host:pid
+        :param lease: float, seconds without heartbeat after which a running job is lost
+        :param max_attempts: int, lost jobs with this many attempts are marked failed instead
+        :return: sqlite3.Row of the job, None if nothing is left
+        """
+        worker = worker or worker_name()
+
+        def take(cursor):
+            now = time.time()
+            cursor.execute("UPDATE jobs SET status = 'failed', error = 'lease expired' "
+                           "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+                           (now - lease, max_attempts))
+            row = cursor.execute("SELECT id FROM jobs WHERE status = 'pending' "
+                                 "OR (status = 'running' AND heartbeat < ?) "
+                                 "ORDER BY priority DESC, id LIMIT 1", (now - lease,)).fetchone()
+            if row is None:
+                return None
+            cursor.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, "
+                           "started = ?, heartbeat = ?, finished = NULL, error = NULL WHERE id = ?",
+                           (worker, now, now, row['id']))
+            return cursor.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+        return self.__transaction__(take)
+
+    def heartbeat(self, job_id):
+        self.__connection__.execute('UPDATE jobs SET heartbeat = ? WHERE id = ?', (time.time(), job_id))
+
+    def complete(self, job_id, restart_file=None):
+        now = time.time()
+        self.__connection__.execute("UPDATE jobs SET status = 'done', finished = ?, duration = ? - started, "
+                                    "restart_file = ? WHERE id = ?", (now, now, restart_file, job_id))
+
+    def fail(self, job_id, error, max_attempts=3):
+        """
+        Record a failed attempt, the job goes back to the queue until max_attempts is reached
+        """
+        now = time.time()
+        self.__connection__.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                                    "finished = ?, duration = ? - started, error = ? WHERE id = ?",
+                                    (max_attempts, now, now, str(error), job_id))
+
+    def set_priorities(self, job_ids, priorities):
+        """
+        Change the priorities of jobs in one transaction, e.g. to their predicted run time
+        """
+        self.__transaction__(lambda cursor: cursor.executemany(
+            'UPDATE jobs SET priority = ? WHERE id = ?', zip(priorities, job_ids)))
+
+    def reset(self, status='failed'):
+        """
+        Put all jobs with the given status back in the queue
+        :return: int, number of jobs reset
+        """
+        cursor = self.__connection__.execute("UPDATE jobs SET status = 'pending', attempts = 0, error = NULL "
+                                             "WHERE status = ?", (status,))
+        return cursor.rowcount
+
+    def jobs(self, status=None):
+        if status is None:
+            return self.__connection__.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+        return self.__connection__.execute('SELECT * FROM jobs WHERE status = ? ORDER BY id', (status,)).fetchall()
+
+    def summary(self):
+        """
+        :return: dict, number of jobs per status
+        """
+        rows = self.__connection__.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return {row[0]: row[1] for row in rows}
+
+
+def run_job(job, scratch_dir=None, options=()):
+    """
+    Write the job's parameter file and run GALFIT in a private working directory,
+    so concurrent jobs do not share fit.log and galfit.NN
+    :param job: sqlite3.Row or dict, as returned by Campaign.claim
+    :param scratch_dir: str, parent of the working directories, defaults to the system temporary directory
+    :return: str, restart file (galfit.01) copied next to the parameter file, None if GALFIT wrote none
+    """
+    galfit_file = job['galfit_file']
+    with open(galfit_file, 'w') as file:
+        print(job['parameters'], file=file)
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as cwd:
+        run_galfit(galfit_file, options=options, cwd=cwd)
+        restart = os.path.join(cwd, 'galfit.01')
+        if not os.path.exists(restart):
+            return None
+        restart_file = galfit_file + '.01'
+        shutil.copyfile(restart, restart_file)
+        log = os.path.join(cwd, 'fit.log')
+        if os.path.exists(log):
+            shutil.copyfile(log, galfit_file + '.log')
+    return restart_file
+
+
+def run_worker(db_file, worker=None, lease=600, max_attempts=3, scratch_dir=None, options=()):
+    """
+    Claim and run jobs until the campaign is exhausted; start one per core / node to work in parallel
+    A background thread refreshes the heartbeat of the running job every lease / 4 seconds.
+    :return: int, number of jobs processed
+    """
+    worker = worker or worker_name()
+    count = 0
+    with Campaign(db_file) as campaign:
+        while True:
+            job = campaign.claim(worker, lease=lease, max_attempts=max_attempts)
+            if job is None:
+                return count
+            stop = threading.Event()
+
+            def beat(job_id=job['id']):
+                with Campaign(db_file) as store:
+                    while not stop.wait(lease / 4):
+                        store.heartbeat(job_id)
+            thread = threading.Thread(target=beat, daemon=True)
+            thread.start()
+            try:
+                restart_file = run_job(job, scratch_dir=scratch_dir, options=options)
+            except Exception as e:
+                campaign.fail(job['id'], e, max_attempts=max_attempts)
+            else:
+                campaign.complete(job['id'], restart_file)
+            finally:
+                stop.set()
+                thread.join()
+            count += 1
@@ -0,0 +1,86 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from lazy_import import LazyModule
+from fit_result import FitResult, DATA_POINTER, fit_section
+
+fits = LazyModule('astropy.io.fits')
+
+
+def _data_pointer(result, output_file, input_file):
+    # input image the dropped data can be read back from, checked before anything is thrown away
+    if input_file is None:
+        input_file = result.header.get('DATAIN')
+        if not input_file:
+            raise ValueError(f'No input image to point to for {output_file}')
+        if not os.path.isabs(input_file):
+            # GALFIT writes the path it was given, relative to its working directory
+            input_file = os.path.join(os.path.dirname(os.path.abspath(output_file)), input_file)
+    input_file = os.path.abspath(input_file)
+    if not os.path.exists(input_file):
+        raise ValueError(f'Input image {input_file} of {output_file} does not exist, the data are kept')
+    header = fits.getheader(input_file, 0)
+    ny, nx = result.model.shape
+    x1, y1 = fit_section(result.header)
+    if header.get('NAXIS1', 0) < x1 - 1 + nx or header.get('NAXIS2', 0) < y1 - 1 + ny:
+        raise ValueError(f'Input image {input_file} does not cover the fitted section of {output_file}, '
+                         f'the data are kept')
+    return input_file
+
+
+def compact_output(output_file, compacted_file=None, compression='GZIP_2', quantize_level=0,
+                   float32=True, drop_data=False, input_file=None):
+    """
+    Rewrite a GALFIT output cube (or subcomponent cube) in a smaller form readable by FitResult
+    :param output_file: str
+    :param compacted_file: str, the output file itself (replaced atomically) if None
+    :param compression: str, tile compression of the image extensions ('GZIP_2', 'RICE_1', ...), None for none
+    :param quantize_level: float, 0 keeps the float values exactly, else see astropy CompImageHDU (lossy)
+    :param float32: bool, store float64 images as float32
+    :param drop_data: bool, replace the data HDU by a header naming the input image (DATAFILE) and section
+    :param input_file: str, input image of the pointer, the DATAIN keyword of the model HDU by default
+                       (relative to the directory of the output); the data are only dropped if this image
+                       exists and covers the fitted section, pass it when GALFIT ran elsewhere
+    :return: (int, int), sizes before and after [bytes]
+    """
+    compacted_file = compacted_file or output_file
+    before = os.path.getsize(output_file)
+    with FitResult(output_file) as result:
+        cube = result.cube
+        data_hdu = result.hdu(None) if drop_data else None
+        if drop_data:
+            input_file = _data_pointer(result, output_file, input_file)
+        hdus = []
+        for hdu in cube:
+            data = hdu.data
+            header = hdu.header.copy()
+            if hdu is data_hdu:
+                for key in ('NAXIS1', 'NAXIS2'):
+                    header.remove(key, ignore_missing=True)
+                header[DATA_POINTER] = input_file
+                header['FITSECT'] = result.header.get('FITSECT', '')
+                hdus.append(fits.ImageHDU(None, header))
+                continue
+            if data is not None and float32 and data.dtype.kind == 'f':
+                data = data.astype(np.float32)
+            if isinstance(hdu, fits.PrimaryHDU):
+                hdus.append(fits.PrimaryHDU(data, header))
+            elif data is not None and compression is not None:
+                hdus.append(fits.CompImageHDU(data, header, compression_type=compression,
+                                              quantize_level=quantize_level))
+            else:
+                hdus.append(fits.ImageHDU(data, header))
+        part = compacted_file + '.part'
+        fits.HDUList(hdus).writeto(part, overwrite=True)
+    os.replace(part, compacted_file)
+    return before, os.path.getsize(compacted_file)
+
+
+def compact_outputs(output_files, max_workers=None, **kwargs):
+    """
+    Compact many outputs in place, in parallel, see compact_output
+    :return: (int, int), total sizes before and after [bytes]
+    """
+    with ThreadPoolExecutor(max_workers) as executor:
+        sizes = list(executor.map(lambda f: compact_output(f, **kwargs), output_files))
+    return sum(s[0] for s in sizes), sum(s[1] for s in sizes)
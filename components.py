@@ -20,6 +20,12 @@ class Parameter:
     def __str__(self) -> str:
         return f"{self.num}) {self.value} {int(self.trainable)}"
 
+    def __getstate__(self):
+        return self.num, self.value, self.trainable
+
+    def __setstate__(self, state):
+        self.num, self.value, self.trainable = state
+
 
 class DoubleParam(Parameter):
     def __init__(self, num, x, y, trainable_x, trainable_y):
@@ -85,10 +91,43 @@ class Component:
         return file
 
     def __repr__(self) -> str:
-        s = f"0) {self.__type__}\n"
-        for parameter in self.__parameters__:
-            s += parameter.__repr__() + '\n'
-        return s
+        return f"0) {self.__type__}\n" + ''.join([f"{parameter!r}\n" for parameter in self.__parameters__])
+
+    def write(self, file):
+        """
+        Write the component block of the parameter file
+        :param file: text file handle
+        """
+        file.write(self.__repr__())
+
+    def __getstate__(self):
+        # the parameter objects are rebuilt by __init__, only values and flags are stored
+        return [(p.value, p.trainable) for p in self.__parameters__]
+
+    def __setstate__(self, state):
+        self.__init__()
+        for parameter, (value, trainable) in zip(self.__parameters__, state):
+            # json turns the tuples of DoubleParam into lists
+            parameter.value = tuple(value) if isinstance(value, list) else value
+            parameter.trainable = tuple(trainable) if isinstance(trainable, list) else trainable
+
+    def to_dict(self):
+        """
+        Plain python representation, suitable for json or msgpack
+        :return: dict, {'type': str, 'parameters': [[value, trainable], ...]}
+        """
+        return {'type': self.__type__, 'parameters': [list(p) for p in self.__getstate__()]}
+
+    @staticmethod
+    def from_dict(d):
+        """
+        Rebuild a component written by to_dict
+        :param d: dict
+        :return: Component of the recorded type
+        """
+        component = component_names[d['type']].__new__(component_names[d['type']])
+        component.__setstate__(d['parameters'])
+        return component
 
     def set_output_option(self, option):
         # option: bool
@@ -605,6 +644,14 @@ class King(Anisotropic):
     def tidal_radius(self, rt: float):
         self.__tidal_radius__.value = rt
 
+    @alpha.setter
+    def alpha(self, alpha: float):
+        self.__alpha__.value = alpha
+
+    @axis_ratio.setter
+    def axis_ratio(self, ratio: float):
+        self.__axis_ratio__.value = ratio
+
     def set_central_surface_brightness(self, mu_0: float = None, trainable=True):
         """
         Set initial central surface brightness
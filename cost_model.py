@@ -0,0 +1,122 @@
+import heapq
+import numpy as np
+from task import *
+
+COMPONENT_TYPES = list(component_names)
+FEATURES = ['constant', 'log_pixels', 'log_convolution', 'log_components', 'log_free'] + \
+    [f'log_{type}' for type in COMPONENT_TYPES]
+# uncalibrated guess: time ~ 2 us per pixel and free parameter, mildly growing with the convolution box;
+# the component types only count once calibrated
+DEFAULT_COEFFICIENTS = (np.log(2e-6), 1., 0.3, 0., 1.) + (0.,) * len(COMPONENT_TYPES)
+
+
+def parameter_features(parameters):
+    """
+    Cost features of a GALFIT parameter file
+    :param parameters: str, text of the parameter file (GalfitTask.__repr__, or the parameters of a campaign job)
+    :return: 1D array, see FEATURES
+    """
+    pixels, convolution, components, free = 1., 1., 0, 0
+    types = dict.fromkeys(COMPONENT_TYPES, 0)
+    for line in parameters.splitlines():
+        num, sep, rest = line.partition(')')
+        if not sep:
+            continue
+        num, tokens = num.strip(), rest.split('#')[0].split()
+        if num == 'H' and len(tokens) >= 4:
+            x1, x2, y1, y2 = (float(t) for t in tokens[:4])
+            pixels = (x2 - x1 + 1) * (y2 - y1 + 1)
+        elif num == 'I' and len(tokens) >= 2:
+            convolution = float(tokens[0]) * float(tokens[1])
+        elif num == '0':
+            components += 1
+            if tokens and tokens[0] in types:
+                types[tokens[0]] += 1
+        elif num.isdigit() and len(tokens) >= 2 and len(tokens) % 2 == 0:
+            # values followed by as many fit flags
+            free += sum(t == '1' for t in tokens[len(tokens) // 2:])
+    return np.array([1., np.log(pixels), np.log(convolution), np.log1p(components), np.log1p(free),
+                     *np.log1p(list(types.values()))])
+
+
+def task_features(task: GalfitTask):
+    return parameter_features(task.__repr__())
+
+
+class CostModel:
+    def __init__(self, coefficients=DEFAULT_COEFFICIENTS):
+        """
+        Run time of a GALFIT fit, log-linear in the features of parameter_features
+        :param coefficients: sequence of float, one per feature
+        """
+        self.coefficients = np.array(coefficients, dtype=float)
+
+    def predict(self, task):
+        """
+        :param task: GalfitTask or str, parameter file text
+        :return: float, expected run time [s]
+        """
+        features = parameter_features(task) if isinstance(task, str) else task_features(task)
+        return float(np.exp(features @ self.coefficients))
+
+    def calibrate(self, tasks, durations, regularization=1.):
+        """
+        Fit the coefficients to measured run times, pulled towards the current ones when data are few
+        :param tasks: list of GalfitTask or str
+        :param durations: list of float, run times [s]
+        :param regularization: float, weight of the current coefficients
+        :return: self
+        """
+        x = np.array([parameter_features(t) if isinstance(t, str) else task_features(t) for t in tasks])
+        y = np.log(np.maximum(np.asarray(durations, dtype=float), 1e-3))
+        prior = self.coefficients
+        a = np.vstack([x, np.sqrt(regularization) * np.eye(len(prior))])
+        b = np.concatenate([y, np.sqrt(regularization) * prior])
+        self.coefficients = np.linalg.lstsq(a, b, rcond=None)[0]
+        return self
+
+    def calibrate_from_campaign(self, campaign, regularization=1.):
+        """
+        Calibrate on the finished jobs of a campaign.Campaign
+        :return: self
+        """
+        jobs = [job for job in campaign.jobs('done') if job['duration'] is not None]
+        if jobs:
+            self.calibrate([job['parameters'] for job in jobs], [job['duration'] for job in jobs], regularization)
+        return self
+
+
+def longest_first(costs):
+    """
+    :param costs: list of float
+    :return: list of int, indices by decreasing cost
+    """
+    return sorted(range(len(costs)), key=lambda i: -costs[i])
+
+
+def pack(costs, n_nodes):
+    """
+    Longest-processing-time-first assignment of jobs to nodes, within 4/3 of the optimal makespan
+    :param costs: list of float
+    :param n_nodes: int
+    :return: (list of list of int, list of float), job indices and total cost per node
+    """
+    heap = [(0., node) for node in range(n_nodes)]
+    bins = [[] for _ in range(n_nodes)]
+    loads = [0.] * n_nodes
+    for i in longest_first(costs):
+        load, node = heapq.heappop(heap)
+        bins[node].append(i)
+        loads[node] = load + costs[i]
+        heapq.heappush(heap, (loads[node], node))
+    return bins, loads
+
+
+def prioritize(campaign, model: CostModel):
+    """
+    Set the priority of the pending jobs of a campaign to their predicted run time, so the longest run first
+    :return: int, number of jobs updated
+    """
+    jobs = campaign.jobs('pending')
+    campaign.set_priorities([job['id'] for job in jobs], [model.predict(job['parameters']) for job in jobs])
+    return len(jobs)
@@ -0,0 +1,95 @@
+import numpy as np
+from lazy_import import LazyModule
+
+vis = LazyModule('astropy.visualization')
+
+# pixels used to estimate a display interval
+MAX_SAMPLE = 100000
+# longest side of the image actually drawn in a panel
+MAX_DISPLAY = 1024
+
+
+def subsample(data, max_pixels=MAX_SAMPLE):
+    """
+    Regularly strided sample of the finite pixels of an image
+    :param data: 2D array, masked arrays use their unmasked pixels
+    :param max_pixels: int, approximate size of the sample
+    :return: 1D array
+    """
+    step = max(1, int(np.ceil(np.sqrt(data.size / max_pixels))))
+    sample = data[::step, ::step]
+    if np.ma.isMaskedArray(sample):
+        sample = sample.compressed()
+    sample = np.asarray(sample, dtype=float).ravel()
+    return sample[np.isfinite(sample)]
+
+
+def display_interval(data, cut_coeff=None, min_max=None, max_pixels=MAX_SAMPLE):
+    """
+    Display limits of an image, estimated from a subsample of its pixels
+    :param cut_coeff: float, percentile kept (PercentileInterval), or 'zscale' for the IRAF zscale limits
+    :param min_max: tuple, (vmin, vmax) used as is when cut_coeff is None
+    :return: (vmin, vmax)
+    """
+    if cut_coeff is None and min_max is not None:
+        return tuple(min_max)
+    sample = subsample(data, max_pixels)
+    if sample.size == 0:
+        return 0., 1.
+    if cut_coeff == 'zscale':
+        interval = vis.ZScaleInterval()
+    elif cut_coeff is not None:
+        interval = vis.PercentileInterval(cut_coeff)
+    else:
+        interval = vis.MinMaxInterval()
+    return interval.get_limits(sample)
+
+
+def downsample(data, factor=2):
+    """
+    Block average, the last rows and columns that do not fill a block are dropped
+    """
+    ny, nx = data.shape[0] // factor, data.shape[1] // factor
+    blocks = np.asarray(data, dtype=float)[:ny * factor, :nx * factor].reshape(ny, factor, nx, factor)
+    return blocks.mean(axis=(1, 3))
+
+
+class Preview:
+    def __init__(self, data):
+        """
+        Pyramid of block-averaged copies of an image, each level half the size of the previous,
+        computed on first use and kept for later figures
+        :param data: 2D array, not modified
+        """
+        self.__levels__ = [data]
+
+    @property
+    def shape(self):
+        return self.__levels__[0].shape
+
+    def level(self, max_size=MAX_DISPLAY):
+        """
+        :param max_size: int, longest side wanted
+        :return: (2D array, int), the first level not larger than max_size and its binning factor
+        """
+        k = 0
+        while max(self.__levels__[k].shape) > max_size and min(self.__levels__[k].shape) >= 4:
+            k += 1
+            if k == len(self.__levels__):
+                self.__levels__.append(downsample(self.__levels__[k - 1]))
+        return self.__levels__[k], 2 ** k
+
+    def show(self, ax, cut_coeff=None, min_max=None, stretch=None, max_size=MAX_DISPLAY, **kwargs):
+        """
+        Draw the image with the interval of the full-resolution data and the extent of the full image,
+        so overlays keep using pixel coordinates
+        :param stretch: astropy stretch, LogStretch by default
+        :param kwargs: passed on to imshow
+        """
+        vmin, vmax = display_interval(self.__levels__[0], cut_coeff, min_max)
+        norm = vis.ImageNormalize(vmin=vmin, vmax=vmax, stretch=stretch or vis.LogStretch(), clip=True)
+        image, factor = self.level(max_size)
+        ny, nx = image.shape
+        kwargs.setdefault('cmap', 'gray')
+        return ax.imshow(image, origin='lower', norm=norm,
+                         extent=(-0.5, nx * factor - 0.5, -0.5, ny * factor - 0.5), **kwargs)
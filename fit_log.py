@@ -0,0 +1,176 @@
+import json
+import os
+import re
+from sqlite_store import SQLiteStore
+
+# flags GALFIT writes around a value in fit.log
+FLAGS = {'[': 'fixed', '*': 'problem', '{': 'constrained', '(': 'free'}
+
+__headers__ = {'Input image': 'input_file', 'Init. par. file': 'init_file', 'Restart file': 'restart_file',
+               'Output image': 'output_file'}
+__separator__ = re.compile(rb'^-{20,}\s*$', re.M)
+__token__ = re.compile(r'\[[^\]]*\]|\*[^*]*\*|\{[^}]*\}|\([^)]*\)|[^\s\[\](){}*,]+')
+__number__ = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|[-+]?nan|[-+]?inf', re.I)
+
+__schema__ = '''
+CREATE TABLE IF NOT EXISTS logs (
+    log_file TEXT PRIMARY KEY,
+    inode INTEGER,
+    offset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    log_file TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    input_file TEXT,
+    section TEXT,
+    init_file TEXT,
+    restart_file TEXT,
+    output_file TEXT,
+    chi2 REAL,
+    ndof INTEGER,
+    chi2nu REAL,
+    components TEXT,
+    UNIQUE (log_file, offset)
+);
+CREATE INDEX IF NOT EXISTS fits_output ON fits (output_file);
+'''
+
+
+def _values(text, flag='free'):
+    # numbers of a parameter line with their flags; '(' groups (positions) inherit the flag of their content
+    values, flags = [], []
+    for token in __token__.findall(text):
+        inner_flag = FLAGS.get(token[0])
+        if inner_flag is None:
+            numbers = __number__.findall(token)
+            values.extend(float(n) for n in numbers)
+            flags.extend([flag] * len(numbers))
+        elif token[0] == '(':
+            v, f = _values(token[1:-1], flag)
+            values.extend(v)
+            flags.extend(f)
+        else:
+            v, f = _values(token[1:-1], inner_flag)
+            values.extend(v)
+            flags.extend(f)
+    return values, flags
+
+
+def parse_entry(text):
+    """
+    Parse one fit of fit.log
+    :param text: str, lines between two separator lines
+    :return: dict with input_file, section, init_file, restart_file, output_file, chi2, ndof, chi2nu and
+             components: list of dict with type, values, errors and flags ('free', 'fixed', 'problem',
+             'constrained'), in the order of the log; None if the entry has no Chi^2/nu line
+    """
+    entry = {'input_file': None, 'section': None, 'init_file': None, 'restart_file': None,
+             'output_file': None, 'chi2': None, 'ndof': None, 'chi2nu': None, 'components': []}
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            continue
+        name, sep, rest = stripped.partition(':')
+        name = name.strip()
+        if sep and name in __headers__:
+            entry[__headers__[name]] = rest.strip()
+        elif stripped.startswith('Chi^2/nu'):
+            entry['chi2nu'] = float(__number__.findall(stripped.partition('=')[2])[0])
+        elif stripped.startswith('Chi^2'):
+            match = re.match(r'Chi\^2\s*=\s*(\S+),\s*ndof\s*=\s*(\d+)', stripped)
+            if match is not None:
+                entry['chi2'], entry['ndof'] = float(match.group(1)), int(match.group(2))
+        elif stripped.startswith('(') and entry['components']:
+            entry['components'][-1]['errors'] = _values(stripped)[0]
+        elif sep and re.fullmatch(r'[A-Za-z][\w-]*', name):
+            values, flags = _values(rest)
+            entry['components'].append({'type': name, 'values': values, 'errors': [], 'flags': flags})
+    if entry['chi2nu'] is None:
+        return None
+    match = re.fullmatch(r'(.*?)(\[[\d:,\s]+\])', entry['input_file'] or '')
+    if match is not None:
+        entry['input_file'], entry['section'] = match.group(1), match.group(2)
+    return entry
+
+
+def read_entries(log_file, offset=0):
+    """
+    Parse the complete entries of a log from a byte offset
+    An entry is complete once its Chi^2/nu line (the last one) is written, so a fit being logged is left for later.
+    :return: (list of (int, dict), int), offset and parsed entry of each fit, and the offset to resume from
+    """
+    with open(log_file, 'rb') as file:
+        file.seek(offset)
+        text = file.read()
+    separators = [m.start() for m in __separator__.finditer(text)]
+    entries = []
+    end = 0
+    for start, stop in zip(separators, separators[1:] + [len(text)]):
+        chunk = text[start:stop]
+        entry = parse_entry(chunk.split(b'\n', 1)[-1].decode(errors='replace'))
+        if stop == len(text) and (entry is None or not chunk.endswith(b'\n')):
+            break
+        if entry is not None:
+            entries.append((offset + start, entry))
+        end = stop
+    return entries, offset + end
+
+
+class FitLogIndex(SQLiteStore):
+    def __init__(self, db_file, timeout=60):
+        """
+        Fits parsed from GALFIT logs, in a SQLite table indexed by output file
+        :param db_file, timeout: see SQLiteStore
+        """
+        SQLiteStore.__init__(self, db_file, __schema__, timeout)
+
+    def update(self, log_file):
+        """
+        Parse what was appended to a log since the last update; a truncated or replaced log is read again
+        :return: int, number of fits added
+        """
+        log_file = os.path.abspath(log_file)
+        stat = os.stat(log_file)
+        row = self.__connection__.execute('SELECT inode, offset FROM logs WHERE log_file = ?',
+                                          (log_file,)).fetchone()
+        offset = 0
+        if row is not None and row['inode'] == stat.st_ino and row['offset'] <= stat.st_size:
+            offset = row['offset']
+        entries, end = read_entries(log_file, offset)
+        rows = [(log_file, start, e['input_file'], e['section'], e['init_file'], e['restart_file'],
+                 e['output_file'], e['chi2'], e['ndof'], e['chi2nu'], json.dumps(e['components']))
+                for start, e in entries]
+        with self.__connection__:
+            if offset == 0:
+                self.__connection__.execute('DELETE FROM fits WHERE log_file = ?', (log_file,))
+            self.__connection__.executemany(
+                'INSERT OR REPLACE INTO fits (log_file, offset, input_file, section, init_file, restart_file, '
+                'output_file, chi2, ndof, chi2nu, components) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.__connection__.execute('INSERT OR REPLACE INTO logs VALUES (?, ?, ?)',
+                                        (log_file, stat.st_ino, end))
+        return len(rows)
+
+    def fits(self, output_file=None):
+        """
+        :param output_file: str, as written in the log (the B parameter), all fits if None
+        :return: list of dict, see parse_entry, with log_file and offset, in the order they were logged
+        """
+        if output_file is None:
+            cursor = self.__connection__.execute('SELECT * FROM fits ORDER BY id')
+        else:
+            cursor = self.__connection__.execute('SELECT * FROM fits WHERE output_file = ? ORDER BY id',
+                                                 (output_file,))
+        records = []
+        for row in cursor:
+            record = dict(row)
+            record['components'] = json.loads(record['components'])
+            records.append(record)
+        return records
+
+    def latest(self, output_file):
+        """
+        :return: dict, last fit logged for an output file, None if there is none
+        """
+        records = self.fits(output_file)
+        return records[-1] if records else None
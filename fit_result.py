@@ -0,0 +1,191 @@
+import hashlib
+import os
+import re
+import numpy as np
+from lazy_import import LazyModule
+
+fits = LazyModule('astropy.io.fits')
+
+# header keyword of a data HDU dropped by compaction, naming the input image; FITSECT gives the section
+DATA_POINTER = 'DATAFILE'
+
+
+def fit_section(header):
+    """
+    Origin of the output cube in the input image, from the FITSECT keyword GALFIT writes
+    :return: tuple, (x1, y1), (1, 1) if the keyword is missing
+    """
+    section = header.get('FITSECT', '')
+    match = re.match(r'\[(\d+):\d+,(\d+):\d+\]', section.strip())
+    if match is None:
+        return 1, 1
+    return int(match.group(1)), int(match.group(2))
+
+
+def file_fingerprint(file_name):
+    """
+    :return: tuple, (modification time [ns], size [bytes]), None if the file does not exist
+    """
+    if file_name is None or not os.path.exists(file_name):
+        return None
+    stat = os.stat(file_name)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def array_fingerprint(data):
+    """
+    Digest of the values of an array, for outputs rewritten with the same content
+    :return: str, None for None
+    """
+    if data is None:
+        return None
+    data = np.ascontiguousarray(data)
+    digest = hashlib.blake2b(data.view(np.uint8).reshape(-1), digest_size=16)
+    digest.update(str((data.dtype.str, data.shape)).encode())
+    return digest.hexdigest()
+
+
+class FitResult:
+    def __init__(self, output_file, mask_file=None, components_file=None):
+        """
+        Outputs of one GALFIT run, each file opened once, lazily and memory-mapped
+        Arrays are shared by every user (plotting, profiles, statistics) and must not be modified in place.
+        :param output_file: str, GALFIT output cube
+        :param mask_file: str, mask of the input frame (non-zero = bad), None or 'none' for no mask
+        :param components_file: str, subcomponent cube (GALFIT mode 3), None if not available
+        """
+        self.__output_file__ = output_file
+        self.__mask_file__ = None if mask_file == 'none' else mask_file
+        self.__components_file__ = components_file
+        self.__cube__ = None
+        self.__mask__ = None
+        self.__components__ = None
+        self.__data__ = None
+
+    @property
+    def output_file(self):
+        return self.__output_file__
+
+    @property
+    def mask_file(self):
+        return self.__mask_file__
+
+    @property
+    def components_file(self):
+        return self.__components_file__
+
+    @property
+    def cube(self):
+        if self.__cube__ is None:
+            self.__cube__ = fits.open(self.__output_file__, memmap=True)
+        return self.__cube__
+
+    def hdu(self, object_name):
+        """
+        HDU of the output cube by its OBJECT keyword: 'model', 'residual map', anything else is the data
+        """
+        for hdu in self.cube[1:]:
+            type = hdu.header.get('OBJECT', '').strip()
+            if type == object_name or (object_name is None and type not in ('model', 'residual map')):
+                return hdu
+        raise KeyError(f'No {object_name or "data"} HDU in {self.__output_file__}')
+
+    @property
+    def data(self):
+        """
+        Input image of the fitted region; read from the input file if the cube was compacted without it
+        """
+        hdu = self.hdu(None)
+        if hdu.data is not None:
+            return hdu.data
+        if self.__data__ is None:
+            ny, nx = self.model.shape
+            x1, y1 = fit_section(hdu.header)
+            with fits.open(hdu.header[DATA_POINTER], memmap=True) as hdul:
+                self.__data__ = np.array(hdul[0].data[y1-1:y1-1+ny, x1-1:x1-1+nx])
+        return self.__data__
+
+    @property
+    def model(self):
+        return self.hdu('model').data
+
+    @property
+    def residual(self):
+        return self.hdu('residual map').data
+
+    @property
+    def header(self):
+        return self.hdu('model').header
+
+    @property
+    def chi2nu(self):
+        return float(self.header['CHI2NU'])
+
+    @property
+    def origin(self):
+        return fit_section(self.header)
+
+    @property
+    def mask(self):
+        """
+        Mask cut to the fitted region, None without a mask file
+        """
+        if self.__mask_file__ is None:
+            return None
+        if self.__mask__ is None:
+            self.__mask__ = fits.open(self.__mask_file__, memmap=True)
+        mask = self.__mask__[0].data
+        ny, nx = self.model.shape
+        if mask.shape != (ny, nx):
+            x1, y1 = self.origin
+            mask = mask[y1-1:y1-1+ny, x1-1:x1-1+nx]
+        return mask
+
+    @property
+    def components(self):
+        """
+        Subcomponent cube, None if no components file was given
+        """
+        if self.__components_file__ is None:
+            return None
+        if self.__components__ is None:
+            self.__components__ = fits.open(self.__components_file__, memmap=True)
+        return self.__components__
+
+    @property
+    def component_images(self):
+        """
+        :return: list of (str, 2D array), OBJECT type and image of every subcomponent
+        """
+        if self.components is None:
+            return []
+        return [(hdu.header['OBJECT'].strip(), hdu.data) for hdu in self.components[1:]]
+
+    @property
+    def sky(self):
+        for type, data in self.component_images:
+            if type == 'sky':
+                return data
+        return None
+
+    @property
+    def fingerprint(self):
+        """
+        :return: tuple, file_fingerprint of the output, mask and components files
+        """
+        return tuple(file_fingerprint(f) for f in (self.__output_file__, self.__mask_file__, self.__components_file__))
+
+    def close(self):
+        for hdul in (self.__cube__, self.__components__, self.__mask__):
+            if hdul is not None:
+                hdul.close()
+        self.__cube__ = None
+        self.__components__ = None
+        self.__mask__ = None
+        self.__data__ = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
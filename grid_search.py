@@ -0,0 +1,122 @@
+import copy
+import itertools
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from task import *
+from profiles import set_parameter
+
+
+def grid_variants(grid):
+    """
+    Cartesian product of the candidate values
+    :param grid: dict, (component index, parameter name) -> list of values,
+                 e.g. {(0, 'sersic_index'): [1, 2, 4], (0, 'effective_radius'): [5, 10, 20]}
+    :return: list of dict, (component index, parameter name) -> value
+    """
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def random_variants(ranges, n_samples, seed=None):
+    """
+    Uniform random samples of the starting values
+    :param ranges: dict, (component index, parameter name) -> (low, high)
+    :param n_samples: int, number of variants
+    :param seed: int, random seed
+    :return: list of dict, (component index, parameter name) -> value
+    """
+    rng = np.random.default_rng(seed)
+    samples = {key: rng.uniform(low, high, n_samples) for key, (low, high) in ranges.items()}
+    return [{key: float(samples[key][i]) for key in ranges} for i in range(n_samples)]
+
+
+class Variant:
+    def __init__(self, task: GalfitTask, values, index, work_dir):
+        self.values = values
+        self.task = copy.deepcopy(task)
+        self.task.config.abspath()
+        for (component, name), value in values.items():
+            set_parameter(self.task.components[component], name, value)
+        self.task.config.output_file = os.path.join(work_dir, f'variant{index:04d}_out.fits')
+        self.galfit_file = os.path.join(work_dir, f'variant{index:04d}.galfit')
+        self.cwd = os.path.join(work_dir, f'variant{index:04d}')
+        os.makedirs(self.cwd, exist_ok=True)
+        self.chi2nu = np.inf
+        self.rounds = 0
+
+    def run(self, imax=None):
+        options = () if imax is None else ('-imax', str(int(imax)))
+        restart = os.path.join(self.cwd, 'galfit.01')
+        if os.path.exists(restart):
+            os.remove(restart)
+        try:
+            self.task.run(self.galfit_file, options=options, cwd=self.cwd)
+            self.chi2nu = read_chi2nu(self.task.config.output_file)
+            # continue the next round from the fitted values
+            self.task.read_component(restart)
+        except (subprocess.CalledProcessError, OSError, KeyError):
+            self.chi2nu = np.inf
+        self.rounds += 1
+        return self
+
+
+def grid_search(task: GalfitTask, variants, max_workers=None, imax=(10, 40), keep=0.25,
+                work_dir=None):
+    """
+    Fit many starting points and keep the best one by chi2nu
+    Losing variants are stopped early by successive halving: every variant first runs with at most
+    imax[0] iterations, only the best fraction (keep) goes on to the next round with imax[1], and so on;
+    the survivors of the last round are fitted to convergence.
+    :param task: GalfitTask, the starting point, its own components and config are not modified
+    :param variants: list of dict, (component index, parameter name) -> starting value,
+                     see grid_variants and random_variants
+    :param max_workers: int, number of GALFIT processes running at once (the per-galaxy CPU budget)
+    :param imax: iterable of int, iteration limits of the early-stopping rounds
+    :param keep: float, fraction of the variants kept after each round (at least one)
+    :param work_dir: str, directory for the variant files, a temporary directory if None
+    :return: (GalfitTask, list of dict), best task with fitted components and its output copied to the
+             original output file, and one record per variant with 'values', 'chi2nu' and 'rounds'
+    """
+    output_file = os.path.abspath(task.config.output_file)
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        alive = [Variant(task, values, i, tmp) for i, values in enumerate(variants)]
+        everyone = list(alive)
+        with ThreadPoolExecutor(max_workers) as executor:
+            for limit in list(imax) + [None]:
+                alive = list(executor.map(lambda v: v.run(limit), alive))
+                alive.sort(key=lambda v: v.chi2nu)
+                if limit is not None:
+                    alive = alive[:max(1, int(np.ceil(len(alive) * keep)))]
+        best = alive[0]
+        if not np.isfinite(best.chi2nu):
+            raise RuntimeError('GALFIT failed for every variant')
+        shutil.copyfile(best.task.config.output_file, output_file)
+        best.task.config.output_file = output_file
+        records = [{'values': v.values, 'chi2nu': v.chi2nu, 'rounds': v.rounds} for v in everyone]
+    return best.task, records
+
+
+def grid_search_batch(tasks, variants, cpu_budget=None, cpus_per_galaxy=4, **kwargs):
+    """
+    Run grid_search over many galaxies, cpus_per_galaxy GALFIT processes each
+    :param tasks: list of GalfitTask
+    :param variants: list of dict shared by all galaxies, or a function task -> list of dict
+    :param cpu_budget: int, total number of GALFIT processes, defaults to the number of cores
+    :param cpus_per_galaxy: int, per-galaxy budget
+    :param kwargs: passed on to grid_search
+    :return: list of (GalfitTask, records), None where every variant failed
+    """
+    cpu_budget = cpu_budget or os.cpu_count()
+
+    def search(task):
+        candidates = variants(task) if callable(variants) else variants
+        try:
+            return grid_search(task, candidates, max_workers=cpus_per_galaxy, **kwargs)
+        except RuntimeError:
+            return None
+    with ThreadPoolExecutor(max(1, cpu_budget // cpus_per_galaxy)) as executor:
+        return list(executor.map(search, tasks))
@@ -0,0 +1,102 @@
+import fnmatch
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from task import *
+from sqlite_store import SQLiteStore
+
+# header keywords Config reads from the images and the PSFs
+KEYWORDS = ['NAXIS1', 'NAXIS2', 'ZPT_GSC', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2', 'SCALE']
+PATTERNS = ('*.fits', '*.fit', '*.fits.gz', '*.fits.fz')
+
+__schema__ = '''
+CREATE TABLE IF NOT EXISTS headers (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    header TEXT NOT NULL
+);
+'''
+
+
+def header_values(file_name, keywords=KEYWORDS):
+    """
+    Read the keywords of the primary header, only the header blocks are read
+    :return: dict, keyword -> value, with the fallback of read_header; missing keywords are left out
+    """
+    header = fits.getheader(file_name, 0)
+    values = {}
+    for key in keywords:
+        try:
+            values[key] = read_header(header, key)
+        except KeyError:
+            pass
+    return values
+
+
+class HeaderIndex(SQLiteStore):
+    def __init__(self, db_file, timeout=60):
+        """
+        Header values of the images and PSFs of a survey, kept in a SQLite file
+        Build it once with scan, then make Configs with config without opening any FITS file.
+        :param db_file, timeout: see SQLiteStore
+        """
+        SQLiteStore.__init__(self, db_file, __schema__, timeout)
+
+    def __len__(self):
+        return self.__connection__.execute('SELECT COUNT(*) FROM headers').fetchone()[0]
+
+    def scan(self, root, patterns=PATTERNS, max_workers=None):
+        """
+        Index the FITS files under a directory; files whose mtime and size did not change are not reopened,
+        entries of files that no longer exist are removed
+        :param root: str, directory scanned recursively
+        :param patterns: tuple of str, file name patterns
+        :param max_workers: int, number of threads reading headers
+        :return: (int, int), number of files read and removed
+        """
+        root = os.path.abspath(root)
+        stats = {}
+        for dir_path, _, file_names in os.walk(root):
+            for file_name in file_names:
+                if any(fnmatch.fnmatch(file_name, pattern) for pattern in patterns):
+                    path = os.path.join(dir_path, file_name)
+                    stat = os.stat(path)
+                    stats[path] = (stat.st_mtime_ns, stat.st_size)
+        prefix = os.path.join(root, '')
+        known = {path: (mtime, size) for path, mtime, size in self.__connection__.execute(
+            'SELECT path, mtime, size FROM headers WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))}
+        changed = [path for path, stat in stats.items() if known.get(path) != stat]
+        removed = [path for path in known if path not in stats]
+
+        def read(path):
+            try:
+                return path, header_values(path)
+            except (OSError, IndexError):
+                return path, None
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            rows = [(path, *stats[path], json.dumps(values))
+                    for path, values in executor.map(read, changed) if values is not None]
+        with self.__connection__:
+            self.__connection__.executemany('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)', rows)
+            self.__connection__.executemany('DELETE FROM headers WHERE path = ?', [(p,) for p in removed])
+        return len(rows), len(removed)
+
+    def header(self, file_name):
+        """
+        :return: dict, keyword -> value of an indexed file
+        """
+        row = self.__connection__.execute('SELECT header FROM headers WHERE path = ?',
+                                          (os.path.abspath(file_name),)).fetchone()
+        if row is None:
+            raise KeyError(f'{file_name} is not in the index {self.__db_file__}')
+        return json.loads(row[0])
+
+    def config(self, input_file, output_file=None, psf_file='none', sigma_file='none', mask_file='none'):
+        """
+        Config from the indexed headers, same arguments and values as Config(...)
+        :return: Config
+        """
+        return Config.from_dict(header_config(input_file, self.header(input_file), psf_file,
+                                              self.header(psf_file), output_file, sigma_file, mask_file))
@@ -0,0 +1,24 @@
+import importlib
+
+
+class LazyModule:
+    def __init__(self, name):
+        """
+        Stand-in for a module that is only imported on first attribute access,
+        keeps heavy dependencies (astropy, scipy, matplotlib, photutils) out of worker start-up
+        :param name: str, full module name, e.g. 'astropy.io.fits'
+        """
+        self.__lazy_name__ = name
+        self.__lazy_module__ = None
+
+    def __load__(self):
+        if self.__lazy_module__ is None:
+            self.__lazy_module__ = importlib.import_module(self.__lazy_name__)
+        return self.__lazy_module__
+
+    def __getattr__(self, attr):
+        return getattr(self.__load__(), attr)
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self.__lazy_module__ is not None else 'not loaded'
+        return f"<lazy module '{self.__lazy_name__}' ({state})>"
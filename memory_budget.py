@@ -0,0 +1,145 @@
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from task import *
+from lazy_import import LazyModule
+
+optimize = LazyModule('scipy.optimize')
+
+# peak memory = base + per region pixel + per convolution box pixel [bytes], before any measurement
+DEFAULT_COEFFICIENTS = (64 * 2**20, 200., 100.)
+
+
+def memory_features(config: Config):
+    """
+    :return: 1D array, (1, region pixels, convolution box pixels)
+    """
+    x1, x2, y1, y2 = config.image_region
+    nx, ny = config.convolution_size
+    return np.array([1., (x2 - x1 + 1) * (y2 - y1 + 1), nx * ny], dtype=float)
+
+
+def node_memory():
+    """
+    :return: int, physical memory of the node [bytes]
+    """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def peak_memory(usage):
+    """
+    :param usage: resource.struct_rusage of a process, as returned by run_galfit
+    :return: int, peak resident memory [bytes]
+    """
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class MemoryModel:
+    def __init__(self, coefficients=DEFAULT_COEFFICIENTS, history_file=None, min_samples=5):
+        """
+        Peak resident memory of a GALFIT process, linear in memory_features, refined from measured peaks
+        :param history_file: str, json file keeping the measurements between sessions
+        :param min_samples: int, measurements needed before the default coefficients are replaced
+        """
+        self.coefficients = np.array(coefficients, dtype=float)
+        self.__history_file__ = history_file
+        self.__min_samples__ = min_samples
+        self.__samples__ = []
+        self.__lock__ = threading.Lock()
+        if history_file is not None and os.path.exists(history_file):
+            with open(history_file) as file:
+                self.__samples__ = json.load(file)
+            self.__refit__()
+
+    def estimate(self, config: Config):
+        """
+        :return: float, expected peak memory [bytes]
+        """
+        return float(memory_features(config) @ self.coefficients)
+
+    def observe(self, config: Config, peak):
+        """
+        Record the measured peak memory of a run and refit the coefficients
+        :param peak: float, peak resident memory [bytes]
+        """
+        with self.__lock__:
+            self.__samples__.append([*memory_features(config).tolist(), float(peak)])
+            self.__refit__()
+            if self.__history_file__ is not None:
+                with open(self.__history_file__, 'w') as file:
+                    json.dump(self.__samples__, file)
+
+    def __refit__(self):
+        if len(self.__samples__) < self.__min_samples__:
+            return
+        samples = np.array(self.__samples__)
+        # non-negative, so a larger region or convolution box never lowers the estimate
+        self.coefficients = optimize.nnls(samples[:, :-1], samples[:, -1])[0]
+
+
+class MemoryBudgetExecutor:
+    def __init__(self, budget=None, max_workers=None, model=None, safety=1.25):
+        """
+        Run GalfitTasks in parallel while the sum of their estimated peak memory stays within a budget
+        A job larger than the whole budget still runs, alone.
+        :param budget: float, memory available to GALFIT processes [bytes], 80% of the node memory by default
+        :param max_workers: int, maximum number of processes, the number of cores by default
+        :param model: MemoryModel, refined with the peak memory of every finished process
+        :param safety: float, factor applied to the estimates
+        """
+        self.budget = budget or 0.8 * node_memory()
+        self.model = model or MemoryModel()
+        self.safety = safety
+        self.__used__ = 0.
+        self.__running__ = 0
+        self.__condition__ = threading.Condition()
+        self.__executor__ = ThreadPoolExecutor(max_workers or os.cpu_count())
+
+    def shutdown(self, wait=True):
+        self.__executor__.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    @property
+    def used(self):
+        """
+        :return: float, estimated memory of the running jobs [bytes]
+        """
+        return self.__used__
+
+    def submit(self, task: GalfitTask, galfit_file=None, galfit_mode=0, options=(), cwd=None, stage=None):
+        """
+        Queue a task, run by GalfitTask.run with the same arguments once its memory fits in the budget
+        :return: concurrent.futures.Future, its result is the peak resident memory of the process [bytes]
+        """
+        return self.__executor__.submit(self.__run__, task, galfit_file, galfit_mode, options, cwd, stage)
+
+    def __run__(self, task, galfit_file, galfit_mode, options, cwd, stage):
+        config = task.config
+        need = self.safety * self.model.estimate(config)
+        with self.__condition__:
+            self.__condition__.wait_for(lambda: self.__running__ == 0 or self.__used__ + need <= self.budget)
+            self.__used__ += need
+            self.__running__ += 1
+        try:
+            result = task.run(galfit_file, galfit_mode=galfit_mode, options=options, cwd=cwd, stage=stage)
+            if stage is not None:
+                # the staged outputs occupy the node memory until they are copied back
+                result.result()
+                result = result.rusage
+            peak = peak_memory(result)
+            self.model.observe(config, peak)
+            return peak
+        finally:
+            with self.__condition__:
+                self.__used__ -= need
+                self.__running__ -= 1
+                self.__condition__.notify_all()
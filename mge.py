@@ -0,0 +1,240 @@
+import copy
+import functools
+import numpy as np
+from task import *
+from lazy_import import LazyModule
+from components import component_names
+from profiles import major_axis_profile, pixel_grid, parameter_names, set_parameter, sersic_bn, FWHM_TO_SIGMA
+from photometry import magnitude_to_flux
+from psf_library import load_stamp
+
+optimize = LazyModule('scipy.optimize')
+special = LazyModule('scipy.special')
+
+# Sersic indices of the table, mixtures in between are interpolated linearly
+SERSIC_GRID = np.round(np.arange(0.3, 8.0001, 0.05), 2)
+# widths of the Gaussians of the unit Sersic profile (Re = 1) and the radii where the fit is made
+SIGMAS = np.logspace(-3, 1.3, 32)
+RADII = np.logspace(-3, np.log10(8), 200)
+
+
+def _unit_sersic(r, n):
+    # Sersic profile with Re = 1 and unit total flux, circular
+    b = sersic_bn(n)
+    return np.exp(2 * n * np.log(b) - special.gammaln(2 * n) - b * r ** (1 / n)) / (2 * np.pi * n)
+
+
+def _gaussians(r, sigmas):
+    # unit-flux circular Gaussians at radii r, one column per sigma
+    return np.exp(-r[:, None]**2 / (2 * sigmas**2)) / (2 * np.pi * sigmas**2)
+
+
+def fit_mixture(radii, profile, sigmas, total=None):
+    """
+    Non-negative Gaussian fluxes reproducing a circular profile with the smallest relative error
+    :param radii: 1D array, where the profile is matched
+    :param profile: 1D array, the profile (flux per unit area) at radii
+    :param sigmas: 1D array, widths of the Gaussians
+    :param total: float, total flux of the profile, kept by the mixture when given
+    :return: 1D array, flux of each Gaussian
+    """
+    # the far wings of steep profiles carry no light and would dominate a relative error
+    good = profile > 1e-10 * profile.max()
+    design = _gaussians(radii[good], sigmas) / profile[good, None]
+    # r-weighted: every logarithmic radial bin counts for its share of the light
+    weight = np.sqrt(radii[good] ** 2 * profile[good])
+    weight /= weight.max()
+    design *= weight[:, None]
+    target = weight
+    if total is not None:
+        # Gaussians narrower than the innermost radius are otherwise free to carry any flux
+        design = np.vstack([design, np.full(len(sigmas), np.sqrt(len(target)) / total)])
+        target = np.append(target, np.sqrt(len(target)))
+    # unit columns keep the problem well scaled
+    norm = np.linalg.norm(design, axis=0)
+    norm[norm == 0] = 1
+    return optimize.nnls(design / norm, target, maxiter=50 * len(sigmas))[0] / norm
+
+
+@functools.lru_cache(maxsize=1)
+def sersic_table():
+    """
+    Gaussian fluxes of the unit Sersic profile for every index of SERSIC_GRID, computed once
+    :return: 2D array, (len(SERSIC_GRID), len(SIGMAS))
+    """
+    return np.array([fit_mixture(RADII, _unit_sersic(RADII, n), SIGMAS, total=1.) for n in SERSIC_GRID])
+
+
+def sersic_mixture(n):
+    """
+    :param n: float, Sersic index within SERSIC_GRID
+    :return: (fluxes, sigmas), Gaussians of the unit Sersic profile (Re = 1, total flux 1)
+    """
+    table = sersic_table()
+    k = np.clip(np.searchsorted(SERSIC_GRID, n) - 1, 0, len(SERSIC_GRID) - 2)
+    t = np.clip((n - SERSIC_GRID[k]) / (SERSIC_GRID[k + 1] - SERSIC_GRID[k]), 0, 1)
+    fluxes = (1 - t) * table[k] + t * table[k + 1]
+    keep = fluxes > 0
+    return fluxes[keep] / fluxes.sum(), SIGMAS[keep]
+
+
+@functools.lru_cache(maxsize=4096)
+def _profile_mixture(type, shape_parameters, zeropoint, pixel_scale):
+    # cached on the parameters of the radial profile only, not on position and orientation
+    component = component_names[type]()
+    for name, value in shape_parameters:
+        set_parameter(component, name, value)
+    # radial scale of the profile from its half-light radius, through the cumulative flux
+    r = np.logspace(-3, 4, 2000)
+    profile = major_axis_profile(component, r, zeropoint, pixel_scale)
+    cumulative = np.concatenate([[0.], np.cumsum(np.diff(r) * (profile[1:] * r[1:] + profile[:-1] * r[:-1]) / 2)])
+    scale = r[np.searchsorted(cumulative, cumulative[-1] / 2)]
+    radii = scale * RADII
+    fluxes = fit_mixture(radii, major_axis_profile(component, radii, zeropoint, pixel_scale), scale * SIGMAS)
+    keep = fluxes > 0
+    # fluxes of circular Gaussians; the axis ratio scales the area of each
+    return fluxes[keep] * component.axis_ratio, scale * SIGMAS[keep]
+
+
+def mixture(component, zeropoint=0, pixel_scale=1):
+    """
+    Gaussian expansion of a component along its major axis
+    :param component: Component, any anisotropic type but edgedisk
+    :param zeropoint, pixel_scale: see profiles.model_jacobian
+    :return: (fluxes, sigmas), total flux [counts] and major-axis width [pixels] of each Gaussian
+    """
+    type = component.__type__
+    if type in ('sersic', 'devauc', 'expdisk'):
+        if type == 'sersic':
+            n, re = component.sersic_index, component.effective_radius
+        elif type == 'devauc':
+            n, re = 4., component.effective_radius
+        else:
+            # exponential disk: n = 1 with Re = b_1 rs
+            n, re = 1., component.effective_radius * sersic_bn(1.)
+        fluxes, sigmas = sersic_mixture(n)
+        return fluxes * magnitude_to_flux(component.magnitude, zeropoint), sigmas * re
+    if type == 'gaussian':
+        flux = magnitude_to_flux(component.magnitude, zeropoint)
+        return np.array([flux]), np.array([component.fwhm * FWHM_TO_SIGMA])
+    if type in ('moffat', 'ferrer', 'king', 'nuker'):
+        shape_parameters = tuple((name, getattr(component, name)) for name in parameter_names(component)
+                                 if name not in ('x', 'y', 'position_angle'))
+        return _profile_mixture(type, shape_parameters, zeropoint, pixel_scale)
+    raise ValueError(f'No Gaussian expansion for component type {type}')
+
+
+def psf_mixture(psf, n_sigmas=24):
+    """
+    Circular Gaussian expansion of a PSF image, centred on the array centre as in fftconvolve 'same'
+    :param psf: 2D array
+    :return: (weights, sigmas), weights sum to 1, sigmas in pixels
+    """
+    ny, nx = psf.shape
+    x, y = pixel_grid(psf.shape, origin=(-(nx // 2), -(ny // 2)))
+    sigmas = np.logspace(np.log10(0.3), np.log10(max(nx, ny) / 2), n_sigmas)
+    design = _gaussians(np.hypot(x, y).ravel(), sigmas)
+    weights = optimize.nnls(design, (psf / psf.sum()).ravel())[0]
+    keep = weights > 0
+    return weights[keep] / weights[keep].sum(), sigmas[keep]
+
+
+def _merge_unresolved(fluxes, sigmas, min_sigma=0.1):
+    # Gaussians narrower than a tenth of a pixel are indistinguishable once pixelated: one with the same second moment
+    small = sigmas < min_sigma
+    if small.sum() < 2:
+        return fluxes, sigmas
+    flux = fluxes[small].sum()
+    sigma = np.sqrt(np.sum(fluxes[small] * sigmas[small] ** 2) / flux)
+    return np.append(fluxes[~small], flux), np.append(sigmas[~small], sigma)
+
+
+def render(components, shape, zeropoint=0, pixel_scale=1, origin=(1, 1), psf=None):
+    """
+    Approximate model image from Gaussian expansions, convolved analytically
+    Every Gaussian is widened by the variance of a uniform pixel (1/12), so the image approximates
+    pixel-integrated values and stays finite for point sources; Gaussians narrower than a pixel are
+    scaled to add up to their flux on the pixel grid.
+    :param components: list of Component; psf components use the PSF mixture, sky is added as a plane
+    :param psf: (weights, sigmas) from psf_mixture, None for no convolution
+    :return: 2D array
+    """
+    x, y = pixel_grid(shape, origin)
+    image = np.zeros(shape)
+    psf_weights, psf_sigmas = psf if psf is not None else (np.array([1.]), np.array([0.]))
+    for component in components:
+        type = component.__type__
+        if type == 'sky':
+            xc, yc = (x.min() + x.max()) / 2, (y.min() + y.max()) / 2
+            image += component.background + component.gradient_x * (x - xc) + component.gradient_y * (y - yc)
+            continue
+        if type == 'psf':
+            fluxes = np.array([magnitude_to_flux(component.magnitude, zeropoint)])
+            sigmas, q, pa = np.array([0.]), 1., 0.
+        else:
+            fluxes, sigmas = _merge_unresolved(*mixture(component, zeropoint, pixel_scale))
+            q, pa = component.axis_ratio, component.position_angle
+        # the PSF Gaussians are circular, so every convolved Gaussian stays diagonal in the frame of the component
+        theta = np.radians(pa)
+        dx, dy = x - component.position[0], y - component.position[1]
+        u2 = (-dx * np.sin(theta) + dy * np.cos(theta)) ** 2
+        v2 = (-dx * np.cos(theta) - dy * np.sin(theta)) ** 2
+        extra = psf_sigmas[None, :] ** 2 + 1 / 12
+        major = (sigmas[:, None] ** 2 + extra).ravel()
+        minor = ((q * sigmas[:, None]) ** 2 + extra).ravel()
+        amplitudes = (fluxes[:, None] * psf_weights[None, :]).ravel() / (2 * np.pi * np.sqrt(major * minor))
+        # each Gaussian only within 5 sigma of the centre, the wide ones cover the image, the narrow ones a few pixels
+        j0, i0 = component.position[0] - origin[0], component.position[1] - origin[1]
+        for amplitude, a, b, half in zip(amplitudes, -0.5 / major, -0.5 / minor, 5 * np.sqrt(major)):
+            rows = np.arange(int(i0 - half), int(np.ceil(i0 + half)) + 1)
+            columns = np.arange(int(j0 - half), int(np.ceil(j0 + half)) + 1)
+            if b < -0.5:
+                # below a pixel the samples at the pixel centres no longer add up to the flux: normalize on the grid
+                dx, dy = columns[None, :] - j0, rows[:, None] - i0
+                total = np.exp(a * (-dx * np.sin(theta) + dy * np.cos(theta)) ** 2 +
+                               b * (-dx * np.cos(theta) - dy * np.sin(theta)) ** 2).sum()
+                amplitude *= np.pi / (np.sqrt(a * b) * total)
+            window = (slice(max(rows[0], 0), max(rows[-1] + 1, 0)),
+                      slice(max(columns[0], 0), max(columns[-1] + 1, 0)))
+            image[window] += amplitude * np.exp(a * u2[window] + b * v2[window])
+    return image
+
+
+def prescreen(task: GalfitTask, variants, keep=0.25):
+    """
+    Rank starting points of grid_search by the chi2 per pixel of their approximate model, without running GALFIT
+    :param task: GalfitTask, its components and config are not modified
+    :param variants: list of dict, (component index, parameter name) -> starting value, see grid_search
+    :param keep: float or int, fraction of the variants (at least one) or number of variants returned
+    :return: (list of dict, 1D array), best variants first and the chi2 per pixel of all variants in the given order
+    """
+    config = task.config
+    x1, x2, y1, y2 = config.image_region
+    shape = (y2 - y1 + 1, x2 - x1 + 1)
+    section = (slice(y1 - 1, y2), slice(x1 - 1, x2))
+    pixel_scale = config.pixel_scale
+    data = fits.getdata(config.input_file)[section].astype(float)
+    good = np.isfinite(data)
+    if config.mask_file != 'none':
+        good &= fits.getdata(config.mask_file)[section] == 0
+    if config.sigma_file != 'none':
+        sigma = fits.getdata(config.sigma_file)[section].astype(float)
+        good &= sigma > 0
+    else:
+        # uniform noise from the robust scatter of the data, enough to rank the variants
+        values = data[good]
+        sigma = np.full(shape, 1.4826 * np.median(np.abs(values - np.median(values))))
+    psf = None
+    if config.psf_file != 'none':
+        psf = psf_mixture(load_stamp(config.psf_file))
+    weight = np.where(good, 1 / np.where(good, sigma, 1) ** 2, 0.)
+    data = np.where(good, data, 0.)
+    scores = np.empty(len(variants))
+    for i, values in enumerate(variants):
+        components = copy.deepcopy(task.components)
+        for (component, name), value in values.items():
+            set_parameter(components[component], name, value)
+        model = render(components, shape, config.zeropoint, pixel_scale, (x1, y1), psf)
+        scores[i] = np.sum(weight * (data - model) ** 2) / max(good.sum(), 1)
+    n_keep = keep if isinstance(keep, int) else max(1, int(np.ceil(len(variants) * keep)))
+    return [variants[i] for i in np.argsort(scores, kind='stable')[:n_keep]], scores
@@ -0,0 +1,148 @@
+import copy
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from task import *
+from profiles import parameter_names, get_parameter, is_trainable
+
+
+def noise_realizations(model, n_realizations, sigma=None, residual=None, good=None, seed=None):
+    """
+    Generate noisy copies of the best-fit model one at a time
+    :param model: 2D array, best-fit model of the fitted region
+    :param n_realizations: int, number of images
+    :param sigma: 2D array, noise map; the noise is drawn from N(0, sigma)
+    :param residual: 2D array, data - model; used instead of sigma, the noise is resampled
+                     with replacement from the residual pixels
+    :param good: 2D bool array, pixels used to resample the residuals, all finite ones by default
+    :param seed: int, random seed
+    :return: generator of 2D arrays
+    """
+    rng = np.random.default_rng(seed)
+    if residual is not None:
+        if good is None:
+            good = np.isfinite(residual)
+        pool = residual[good]
+    elif sigma is None:
+        raise ValueError('Either sigma or residual is needed')
+    for _ in range(n_realizations):
+        if residual is not None:
+            yield model + rng.choice(pool, size=model.shape)
+        else:
+            yield model + rng.normal(0., 1., model.shape) * sigma
+
+
+def summarize(samples):
+    """
+    :param samples: dict, key -> list of values
+    :return: dict, key -> dict of mean, std, median, p16, p84 and n (failed runs are dropped)
+    """
+    summary = {}
+    for key, values in samples.items():
+        values = np.asarray(values, dtype=float)
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            continue
+        p16, median, p84 = np.percentile(values, [16, 50, 84])
+        summary[key] = {'mean': float(values.mean()), 'std': float(values.std(ddof=1)) if values.size > 1 else 0.,
+                        'median': float(median), 'p16': float(p16), 'p84': float(p84), 'n': int(values.size)}
+    return summary
+
+
+class MonteCarlo:
+    def __init__(self, task: GalfitTask, method='sigma', work_dir=None):
+        """
+        Rerun a converged task on noise realizations of its best-fit model
+        :param task: GalfitTask, converged, its output cube must exist; it is not modified
+        :param method: str, 'sigma' draws gaussian noise from the sigma image (or, without one, from the
+                       residual rms), 'residual' resamples the residual pixels
+        :param work_dir: str, directory for the temporary images, the system temporary directory by default
+        """
+        if method not in ('sigma', 'residual'):
+            raise ValueError(f'Unknown method {method}')
+        self.__task__ = copy.deepcopy(task)
+        self.__task__.config.abspath()
+        self.__method__ = method
+        self.__work_dir__ = work_dir
+        self.__keys__ = [(i, name) for i, component in enumerate(self.__task__.components)
+                         for name in parameter_names(component) if is_trainable(component, name)]
+
+    @property
+    def keys(self):
+        return self.__keys__
+
+    def realizations(self, n_realizations, seed=None):
+        """
+        Generate full-size input images, the fitted region replaced by the model plus noise
+        :return: generator of 2D arrays
+        """
+        config = self.__task__.config
+        x1, x2, y1, y2 = config.image_region
+        with fits.open(config.output_file) as cube:
+            model = cube[2].data.astype(float)
+            residual = cube[3].data.astype(float)
+        good = np.isfinite(residual)
+        if config.mask_file != 'none':
+            good &= fits.getdata(config.mask_file)[y1-1:y2, x1-1:x2] == 0
+        if self.__method__ == 'residual':
+            noise = noise_realizations(model, n_realizations, residual=residual, good=good, seed=seed)
+        else:
+            if config.sigma_file != 'none':
+                sigma = fits.getdata(config.sigma_file)[y1-1:y2, x1-1:x2].astype(float)
+            else:
+                sigma = np.full(model.shape, np.std(residual[good]))
+            noise = noise_realizations(model, n_realizations, sigma=sigma, seed=seed)
+        image = fits.getdata(config.input_file).astype(float)
+        for region in noise:
+            image[y1-1:y2, x1-1:x2] = region
+            yield image
+
+    def __fit__(self, index, image, header, tmp):
+        task = copy.deepcopy(self.__task__)
+        name = os.path.join(tmp, f'realization{index:05d}')
+        os.makedirs(name)
+        task.config.input_file = name + '.fits'
+        task.config.output_file = name + '_out.fits'
+        fits.writeto(task.config.input_file, image, header)
+        try:
+            task.run(name + '.galfit', cwd=name)
+            task.read_component(os.path.join(name, 'galfit.01'))
+            values = [get_parameter(task.components[i], n) for i, n in self.__keys__]
+        except (subprocess.CalledProcessError, OSError, IndexError):
+            values = [np.nan] * len(self.__keys__)
+        for file in (task.config.input_file, task.config.output_file):
+            if os.path.exists(file):
+                os.remove(file)
+        return values
+
+    def run(self, n_realizations=100, max_workers=None, seed=None):
+        """
+        Fit n_realizations noisy images in parallel
+        Images are generated only when a worker is free, so at most max_workers are held at once.
+        :param n_realizations: int
+        :param max_workers: int, number of GALFIT processes, the number of cores by default
+        :param seed: int, random seed
+        :return: (dict, dict), summary per (component index, parameter name), see summarize,
+                 and the raw samples
+        """
+        max_workers = max_workers or os.cpu_count()
+        header = fits.getheader(self.__task__.config.input_file)
+        samples = {key: [] for key in self.__keys__}
+        with tempfile.TemporaryDirectory(dir=self.__work_dir__) as tmp, \
+                ThreadPoolExecutor(max_workers) as executor:
+            pending = set()
+            images = self.realizations(n_realizations, seed)
+            for index in range(n_realizations):
+                if len(pending) >= max_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self.__collect__(done, samples)
+                pending.add(executor.submit(self.__fit__, index, next(images).copy(), header, tmp))
+            self.__collect__(wait(pending)[0], samples)
+        return summarize(samples), samples
+
+    def __collect__(self, futures, samples):
+        for future in futures:
+            for key, value in zip(self.__keys__, future.result()):
+                samples[key].append(value)
@@ -0,0 +1,171 @@
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from task import *
+from lazy_import import LazyModule
+from profiles import model_jacobian, parameter_names, get_parameter, set_parameter, is_trainable
+from psf_library import load_stamp
+
+optimize = LazyModule('scipy.optimize')
+signal = LazyModule('scipy.signal')
+
+# structural parameters shared by all bands unless told otherwise
+DEFAULT_TIED = ('x', 'y', 'axis_ratio', 'position_angle')
+
+
+class Band:
+    def __init__(self, config: Config):
+        self.config = config
+        x1, x2, y1, y2 = config.image_region
+        self.origin = (x1, y1)
+        self.data = fits.getdata(config.input_file).astype(float)[y1-1:y2, x1-1:x2]
+        self.shape = self.data.shape
+        good = np.isfinite(self.data)
+        if config.mask_file != 'none':
+            good &= fits.getdata(config.mask_file)[y1-1:y2, x1-1:x2] == 0
+        self.good = good
+        if config.sigma_file != 'none':
+            self.sigma = fits.getdata(config.sigma_file).astype(float)[y1-1:y2, x1-1:x2]
+        else:
+            # no sigma image: constant noise from the MAD of the unmasked pixels
+            values = self.data[good]
+            self.sigma = np.full(self.shape, 1.4826 * np.median(np.abs(values - np.median(values))))
+        self.good &= self.sigma > 0
+        if config.psf_file != 'none':
+            self.psf = load_stamp(config.psf_file)
+        else:
+            self.psf = None
+        self.zeropoint = config.zeropoint
+        self.pixel_scale = config.pixel_scale
+
+    def convolve(self, image):
+        if self.psf is None:
+            return image
+        return signal.fftconvolve(image, self.psf, mode='same')
+
+
+class MultiBandTask:
+    def __init__(self, tasks, tied=DEFAULT_TIED, max_workers=None):
+        """
+        Fit the same set of components to several bands at once
+        :param tasks: list of GalfitTask, one per band, with the same component types in the same order
+        :param tied: iterable of str, parameter names shared by all bands
+                     ('x', 'y', 'axis_ratio', 'position_angle', optionally 'effective_radius', 'sersic_index', ...);
+                     magnitudes and sky parameters are always per band
+        :param max_workers: int, number of threads evaluating the bands, defaults to the number of bands
+        """
+        self.__tasks__ = list(tasks)
+        types = [[c.__type__ for c in task.components] for task in self.__tasks__]
+        if any(t != types[0] for t in types[1:]):
+            raise ValueError('All bands must have the same component types in the same order')
+        self.__tied__ = set(tied)
+        self.__max_workers__ = max_workers or len(self.__tasks__)
+        self.__bands__ = None
+        self.__free__ = []
+        for i, component in enumerate(self.__tasks__[0].components):
+            for name in parameter_names(component):
+                if not is_trainable(component, name):
+                    continue
+                if name in self.__tied__ and component.__type__ != 'sky':
+                    self.__free__.append((i, name, tuple(range(len(self.__tasks__)))))
+                else:
+                    self.__free__.extend((i, name, (b,)) for b in range(len(self.__tasks__)))
+        self.__cache__ = (None, None, None)
+
+    @classmethod
+    def from_configs(cls, configs, components, tied=DEFAULT_TIED, max_workers=None):
+        """
+        Build one GalfitTask per config, each with its own copy of the components
+        :param configs: list of Config, one per band
+        :param components: list of Component, initial guesses shared by all bands
+        """
+        tasks = []
+        for config in configs:
+            task = GalfitTask(config)
+            for component in components:
+                task.add_component(copy.deepcopy(component))
+            tasks.append(task)
+        return cls(tasks, tied=tied, max_workers=max_workers)
+
+    @property
+    def tasks(self):
+        return self.__tasks__
+
+    @property
+    def tied(self):
+        return self.__tied__
+
+    @property
+    def bands(self):
+        if self.__bands__ is None:
+            self.__bands__ = [Band(task.config) for task in self.__tasks__]
+        return self.__bands__
+
+    def get_values(self):
+        return np.array([get_parameter(self.__tasks__[bands[0]].components[i], name)
+                         for i, name, bands in self.__free__], dtype=float)
+
+    def set_values(self, values):
+        for value, (i, name, bands) in zip(values, self.__free__):
+            for b in bands:
+                set_parameter(self.__tasks__[b].components[i], name, float(value))
+
+    def __evaluate_band__(self, b):
+        band = self.bands[b]
+        components = self.__tasks__[b].components
+        model = np.zeros(band.shape)
+        sky = np.zeros(band.shape)
+        columns = {}
+        for i, component in enumerate(components):
+            if component.__type__ == 'psf':
+                raise ValueError('psf components are not supported by the multi-band fit')
+            image, jacobian = model_jacobian(component, band.shape, band.zeropoint,
+                                             band.pixel_scale, band.origin)
+            is_sky = component.__type__ == 'sky'
+            if is_sky:
+                sky += image
+            else:
+                model += image
+            for k, (j, name, bands) in enumerate(self.__free__):
+                if j == i and b in bands:
+                    columns[k] = (jacobian[name], is_sky)
+        model = band.convolve(model) + sky
+        weight = 1 / band.sigma[band.good]
+        residual = (band.data[band.good] - model[band.good]) * weight
+        jac = np.zeros((residual.size, len(self.__free__)))
+        for k, (column, is_sky) in columns.items():
+            if not is_sky:
+                column = band.convolve(column)
+            jac[:, k] = -column[band.good] * weight
+        return residual, jac
+
+    def __evaluate__(self, values):
+        key = np.asarray(values).tobytes()
+        if self.__cache__[0] != key:
+            self.set_values(values)
+            with ThreadPoolExecutor(self.__max_workers__) as executor:
+                results = list(executor.map(self.__evaluate_band__, range(len(self.__tasks__))))
+            self.__cache__ = (key, np.concatenate([r[0] for r in results]),
+                              np.vstack([r[1] for r in results]))
+        return self.__cache__[1], self.__cache__[2]
+
+    def fit(self, **kwargs):
+        """
+        Fit all bands simultaneously with scipy.optimize.least_squares and analytic jacobians,
+        the fitted values are written back to the components of every band
+        :param kwargs: passed on to scipy.optimize.least_squares
+        :return: scipy.optimize.OptimizeResult
+        """
+        kwargs.setdefault('x_scale', 'jac')
+        result = optimize.least_squares(lambda p: self.__evaluate__(p)[0], self.get_values(),
+                                        jac=lambda p: self.__evaluate__(p)[1], **kwargs)
+        self.set_values(result.x)
+        result.chi2nu = np.sum(result.fun**2) / max(result.fun.size - result.x.size, 1)
+        return result
+
+    def run(self, galfit_mode=0):
+        """
+        Refine every band with GALFIT, starting from the joint solution
+        """
+        for task in self.__tasks__:
+            task.run(galfit_mode=galfit_mode)
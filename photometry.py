@@ -0,0 +1,204 @@
+import numpy as np
+from components import *
+from lazy_import import LazyModule
+from profiles import sersic_bn, LN10
+
+special = LazyModule('scipy.special')
+
+# Gauss-Legendre nodes for the profiles without a closed-form total flux
+__nodes__, __weights__ = np.polynomial.legendre.leggauss(64)
+
+# All functions take numbers or arrays (broadcast against each other). Magnitudes and surface brightnesses
+# share the zeropoint; sizes are in arcsec where a surface brightness [mag/arcsec^2] is involved.
+
+
+def to_arcsec(pixels, pixel_scale):
+    return np.asarray(pixels) * pixel_scale
+
+
+def to_pixels(arcsec, pixel_scale):
+    return np.asarray(arcsec) / pixel_scale
+
+
+def config_pixel_scale(config):
+    """
+    Pixel size of a Config [arcsec], see Config.pixel_scale
+    """
+    return float(config.pixel_scale)
+
+
+def flux_to_magnitude(flux, zeropoint=0.):
+    return -2.5 * np.log10(flux) + zeropoint
+
+
+def magnitude_to_flux(magnitude, zeropoint=0.):
+    return 10 ** (-0.4 * (np.asarray(magnitude) - zeropoint))
+
+
+def _sersic_log_norm(n):
+    # ln(n e^b Gamma(2n) / b^2n): total flux = 2 pi q Re^2 I_e times this
+    n = np.asarray(n, dtype=float)
+    b = sersic_bn(n)
+    return np.log(n) + b + special.gammaln(2 * n) - 2 * n * np.log(b)
+
+
+def sersic_mu_e(magnitude, effective_radius, sersic_index, axis_ratio=1.):
+    """
+    Surface brightness at the effective radius of a Sersic profile
+    :param effective_radius: arcsec
+    :return: mu_e [mag/arcsec^2]
+    """
+    return np.asarray(magnitude) + 2.5 * np.log10(2 * np.pi * axis_ratio * np.asarray(effective_radius)**2) + \
+        2.5 * _sersic_log_norm(sersic_index) / LN10
+
+
+def sersic_magnitude(mu_e, effective_radius, sersic_index, axis_ratio=1.):
+    """
+    Total magnitude of a Sersic profile from mu_e, inverse of sersic_mu_e
+    """
+    return np.asarray(mu_e) - 2.5 * np.log10(2 * np.pi * axis_ratio * np.asarray(effective_radius)**2) - \
+        2.5 * _sersic_log_norm(sersic_index) / LN10
+
+
+def sersic_mu_0(magnitude, effective_radius, sersic_index, axis_ratio=1.):
+    """
+    Central surface brightness of a Sersic profile, mu_0 = mu_e - 2.5 b_n / ln 10
+    """
+    return sersic_mu_e(magnitude, effective_radius, sersic_index, axis_ratio) - 2.5 * sersic_bn(sersic_index) / LN10
+
+
+def mean_mu_e(magnitude, effective_radius, axis_ratio=1.):
+    """
+    Mean surface brightness inside the effective radius (half of the light), any profile
+    """
+    return np.asarray(magnitude) + 2.5 * np.log10(2 * np.pi * axis_ratio * np.asarray(effective_radius)**2)
+
+
+def expdisk_mu_0(magnitude, scale_length, axis_ratio=1.):
+    """
+    Central surface brightness of an exponential disk
+    :param scale_length: arcsec
+    """
+    return np.asarray(magnitude) + 2.5 * np.log10(2 * np.pi * axis_ratio * np.asarray(scale_length)**2)
+
+
+def expdisk_magnitude(mu_0, scale_length, axis_ratio=1.):
+    return np.asarray(mu_0) - 2.5 * np.log10(2 * np.pi * axis_ratio * np.asarray(scale_length)**2)
+
+
+def edgedisk_magnitude(mu_0, scale_height, scale_length):
+    """
+    Total magnitude of an edge-on disk, sigma0 (r/rs) K1(r/rs) sech^2(z/hs) integrates to 2 pi rs hs sigma0
+    :param scale_height, scale_length: arcsec
+    """
+    return np.asarray(mu_0) - 2.5 * np.log10(2 * np.pi * np.asarray(scale_length) * np.asarray(scale_height))
+
+
+def edgedisk_mu_0(magnitude, scale_height, scale_length):
+    return np.asarray(magnitude) + 2.5 * np.log10(2 * np.pi * np.asarray(scale_length) * np.asarray(scale_height))
+
+
+def _ferrer_area(outer_truncation_radius, alpha, beta, axis_ratio):
+    # integral of (1 - (r/rout)^(2-beta))^alpha over the ellipse
+    k = 2 - np.asarray(beta, dtype=float)
+    return 2 * np.pi * axis_ratio * np.asarray(outer_truncation_radius)**2 * special.beta(2 / k, alpha + 1.) / k
+
+
+def ferrer_magnitude(mu_0, outer_truncation_radius, alpha, beta, axis_ratio=1.):
+    """
+    Total magnitude of a Ferrer profile
+    :param outer_truncation_radius: arcsec
+    """
+    return np.asarray(mu_0) - 2.5 * np.log10(_ferrer_area(outer_truncation_radius, alpha, beta, axis_ratio))
+
+
+def ferrer_mu_0(magnitude, outer_truncation_radius, alpha, beta, axis_ratio=1.):
+    return np.asarray(magnitude) + 2.5 * np.log10(_ferrer_area(outer_truncation_radius, alpha, beta, axis_ratio))
+
+
+def _king_area(core_radius, tidal_radius, alpha, axis_ratio):
+    # integral of the empirical King profile (see profiles) over the ellipse, Gauss-Legendre in r
+    rc, rt, alpha, q = (np.asarray(v, dtype=float)[..., None] for v in (core_radius, tidal_radius, alpha, axis_ratio))
+    r = rt * (__nodes__ + 1) / 2
+    a = (1 + (r / rc) ** 2) ** (-1 / alpha)
+    b = (1 + (rt / rc) ** 2) ** (-1 / alpha)
+    g = (a - b) / (1 - b)
+    return np.sum(__weights__ * g**alpha * r, axis=-1) * rt[..., 0] / 2 * 2 * np.pi * q[..., 0]
+
+
+def king_magnitude(mu_0, core_radius, tidal_radius, alpha=2., axis_ratio=1.):
+    """
+    Total magnitude of an empirical King profile
+    :param core_radius, tidal_radius: arcsec
+    """
+    return np.asarray(mu_0) - 2.5 * np.log10(_king_area(core_radius, tidal_radius, alpha, axis_ratio))
+
+
+def king_mu_0(magnitude, core_radius, tidal_radius, alpha=2., axis_ratio=1.):
+    return np.asarray(magnitude) + 2.5 * np.log10(_king_area(core_radius, tidal_radius, alpha, axis_ratio))
+
+
+def make_components(component_type, x, y, **parameters):
+    """
+    Components from arrays of parameters, one per element after broadcasting
+    :param component_type: Component subclass, e.g. Sersic
+    :param x, y: arrays, positions [pixels]
+    :param parameters: arrays, GALFIT parameters by property name (magnitude, effective_radius, ...)
+    :return: list of component_type
+    """
+    names = list(parameters)
+    arrays = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+                                 *(np.asarray(parameters[name], dtype=float) for name in names))
+    components = []
+    for values in zip(*(array.ravel().tolist() for array in arrays)):
+        component = component_type()
+        component.position = (values[0], values[1])
+        for name, value in zip(names, values[2:]):
+            setattr(component, name, value)
+        components.append(component)
+    return components
+
+
+def sersic_components(x, y, magnitude, effective_radius, sersic_index, axis_ratio=1., position_angle=0.,
+                      pixel_scale=None):
+    """
+    :param pixel_scale: float, if given the radii are in arcsec and converted to pixels
+    """
+    if pixel_scale is not None:
+        effective_radius = to_pixels(effective_radius, pixel_scale)
+    return make_components(Sersic, x, y, magnitude=magnitude, effective_radius=effective_radius,
+                           sersic_index=sersic_index, axis_ratio=axis_ratio, position_angle=position_angle)
+
+
+def expdisk_components(x, y, magnitude, scale_length, axis_ratio=1., position_angle=0., pixel_scale=None):
+    if pixel_scale is not None:
+        scale_length = to_pixels(scale_length, pixel_scale)
+    return make_components(ExpDisk, x, y, magnitude=magnitude, effective_radius=scale_length,
+                           axis_ratio=axis_ratio, position_angle=position_angle)
+
+
+def edgedisk_components(x, y, mu_0, scale_height, scale_length, position_angle=0., pixel_scale=None):
+    if pixel_scale is not None:
+        scale_height = to_pixels(scale_height, pixel_scale)
+        scale_length = to_pixels(scale_length, pixel_scale)
+    return make_components(EdgeDisk, x, y, central_surface_brightness=mu_0, scale_height=scale_height,
+                           scale_length=scale_length, position_angle=position_angle)
+
+
+def ferrer_components(x, y, mu_0, outer_truncation_radius, alpha, beta, axis_ratio=1., position_angle=0.,
+                      pixel_scale=None):
+    if pixel_scale is not None:
+        outer_truncation_radius = to_pixels(outer_truncation_radius, pixel_scale)
+    return make_components(Ferrer, x, y, central_surface_brightness=mu_0,
+                           outer_truncation_radius=outer_truncation_radius, alpha=alpha, beta=beta,
+                           axis_ratio=axis_ratio, position_angle=position_angle)
+
+
+def king_components(x, y, mu_0, core_radius, tidal_radius, alpha=2., axis_ratio=1., position_angle=0.,
+                    pixel_scale=None):
+    if pixel_scale is not None:
+        core_radius = to_pixels(core_radius, pixel_scale)
+        tidal_radius = to_pixels(tidal_radius, pixel_scale)
+    return make_components(King, x, y, central_surface_brightness=mu_0, core_radius=core_radius,
+                           tidal_radius=tidal_radius, alpha=alpha, axis_ratio=axis_ratio,
+                           position_angle=position_angle)
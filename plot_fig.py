@@ -1,19 +1,36 @@
-import matplotlib.pyplot as plt
-from matplotlib.gridspec import GridSpec
-from astropy.io import fits
-import astropy.visualization as vis
-import photutils.isophote as iso
-from photutils.aperture import EllipticalAperture
+import os
+import pickle
 from components import *
+from lazy_import import LazyModule
+from fit_result import FitResult, array_fingerprint
+from display import Preview
+from profiles import major_axis_profile
+
+plt = LazyModule('matplotlib.pyplot')
+gridspec = LazyModule('matplotlib.gridspec')
+fits = LazyModule('astropy.io.fits')
+iso = LazyModule('photutils.isophote')
+aperture = LazyModule('photutils.aperture')
 
 
 class GalfitPlot:
-    def __init__(self, model, mask, components=None, pixel_scale=1, zeropoint=0, 
+    def __init__(self, model, mask=None, components=None, pixel_scale=1, zeropoint=0, 
                  center_position=None, title=None, sma_init=100, eps_init=0.5, 
-                 pa_init=0, minsma=5, maxsma=None, step=0.05, fix_center=False):
-        self.__model__ = model
-        self.__mask__ = mask
-        self.__components__ = components
+                 pa_init=0, minsma=5, maxsma=None, step=0.05, fix_center=False, state_file=None,
+                 fitted_components=None):
+        # model: GALFIT output file, or a FitResult already holding the output, mask and components
+        # state_file: pickle keeping the isophote profiles between sessions, None to keep them in memory only
+        # pixel_scale: pixel size [arcsec] (Config.pixel_scale), scales the sma axis to arcsec and turns the
+        #              surface brightness of the fitted components into counts per pixel
+        # fitted_components: list of Component with the fitted parameters (GalfitTask.components after
+        #                    read_component), used to draw the component profiles analytically
+        if isinstance(model, FitResult):
+            self.__result__ = model
+        else:
+            self.__result__ = FitResult(model, mask, components)
+        self.__model__ = self.__result__.output_file
+        self.__mask__ = self.__result__.mask_file
+        self.__components__ = self.__result__.components_file
         self.__title__ = title
         self.__cen_pos__ = center_position
         self.__pixel_scale__ = pixel_scale
@@ -26,42 +43,69 @@ class GalfitPlot:
         self._step = step
         self._fix_center = fix_center
 
-        if self.__components__ is not None:
-            for hdu in fits.open(self.__components__):
-                if hdu.header['OBJECT'] == 'sky':
-                    self._sky = hdu.data
-                    break
-        else:
-            self._sky = None
-
-    def __plot_model__(self, hdu, ax, cut_coeff=None, min_max=None, is_origin=False):
-        data = hdu.data
-        if is_origin:
-            with fits.open(self.__mask__) as mask:
-                mask_data = mask[0].data
-                data = data * (1-mask_data)
-        min_value = np.min(data)
-        offset = abs(min_value) if min_value < 0 else 0
-        data += offset
-        if cut_coeff is not None:
-            interval = vis.PercentileInterval(cut_coeff)
-        elif min_max is not None:
-            interval = vis.ManualInterval(*min_max)
+        self._sky = self.__result__.sky
+        # state kept between calls of plot, so only panels and profiles whose inputs changed are redone
+        self.__fingerprint__ = self.__result__.fingerprint
+        self.__previews__ = {}
+        self.__figure__ = None
+        self.__drawn__ = {}
+        self.__state_file__ = state_file
+        self.__fitted_components__ = fitted_components
+        self.__profiles__ = {}
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file, 'rb') as file:
+                self.__profiles__ = pickle.load(file)
+
+    @property
+    def result(self):
+        return self.__result__
+
+    def refresh(self):
+        """
+        Reopen the outputs if any of the files changed since they were read
+        :return: bool, whether they changed
+        """
+        fingerprint = self.__result__.fingerprint
+        if fingerprint == self.__fingerprint__:
+            return False
+        self.__result__.close()
+        self.__fingerprint__ = fingerprint
+        self._sky = self.__result__.sky
+        # panel previews are checked against their image in plot, the component previews are not
+        self.__previews__ = {k: v for k, v in self.__previews__.items() if k in self.__drawn__}
+        return True
+
+    def __plot_model__(self, data, ax, cut_coeff=None, min_max=None, is_origin=False, key=None):
+        # key: name of the panel image, its preview pyramid is kept for later figures
+        if key is not None and key in self.__previews__:
+            preview = self.__previews__[key]
         else:
-            interval = vis.MinMaxInterval()
-        norm = vis.ImageNormalize(data, interval=interval,
-                                  stretch=vis.LogStretch(), clip=True)
-        ax.imshow(data, cmap='gray', origin='lower', norm=norm)
+            if is_origin and self.__result__.mask is not None:
+                data = data * (1-self.__result__.mask)
+            # the arrays are shared through the FitResult, the preview never modifies them
+            preview = Preview(data)
+            if key is not None:
+                self.__previews__[key] = preview
+        preview.show(ax, cut_coeff=cut_coeff, min_max=min_max)
 
-    def __plot_1Dpro__(self, hdu, axs, types, label=None, is_origin=False, 
-                       is_comp=False, show_iso=False):
-        data = hdu.data
-        if is_origin:
-            with fits.open(self.__mask__) as mask:
-                data = np.ma.array(data, mask=(mask[0].data == 1))
+    def __panel__(self, key, data, ax, cut_coeff, is_origin=False):
+        # redraw a panel only if its image changed
+        digest = (array_fingerprint(data), cut_coeff,
+                  array_fingerprint(self.__result__.mask) if is_origin else None)
+        if self.__drawn__.get(key) == digest:
+            return
+        print(f'Working on {key}')
+        self.__previews__.pop(key, None)
+        ax.clear()
+        self.__plot_model__(data, ax, cut_coeff=cut_coeff, is_origin=is_origin, key=key)
+        self.__drawn__[key] = digest
+
+    def __isophotes__(self, data, is_origin=False, is_comp=False, show_iso=False):
+        if is_origin and self.__result__.mask is not None:
+            data = np.ma.array(data, mask=(self.__result__.mask == 1))
 
         if (self._sky is not None) and (not is_comp):
-            data -= self._sky
+            data = data - self._sky
 
         if self.__cen_pos__ is None:
             x0 = data.shape[0] / 2
@@ -88,6 +132,36 @@ class GalfitPlot:
         out_list = {'pa': pa, 'pa_err': isolist.pa_err * 180 / np.pi,
                     'eps': isolist.eps, 'eps_err': isolist.ellip_err,
                     'mu': mu, 'mu_err': mu_err}
+
+        if show_iso:
+            fig = plt.figure()
+            ax = fig.add_subplot()
+            self.__plot_model__(data, ax, cut_coeff=99.5)
+            for i in range(5, len(sma_list), 5):
+                aper = aperture.EllipticalAperture((isolist.x0[i], isolist.y0[i]),
+                                          isolist.sma[i], isolist.sma[i] *
+                                          (1 - isolist.eps[i]),
+                                          isolist.pa[i])
+                aper.plot(ax)
+            fig.savefig('iso.pdf', format='pdf')
+            # fig.show()
+        return sma_list, out_list
+
+    def __profile__(self, key, data, is_origin=False, is_comp=False, show_iso=False):
+        # isophote fit of a panel, redone only if the image (or the sky and mask it depends on) changed
+        digest = (array_fingerprint(data),
+                  array_fingerprint(self.__result__.mask) if is_origin else None,
+                  None if is_comp else array_fingerprint(self._sky),
+                  self.__cen_pos__, self.__pixel_scale__, self.__zeropoint__, self._sma, self._eps,
+                  self._pa, self._minsma, self._maxsma, self._step, self._fix_center)
+        cached = self.__profiles__.get(key)
+        if cached is not None and cached[0] == digest:
+            return cached[1], cached[2], False
+        sma_list, out_list = self.__isophotes__(data, is_origin, is_comp, show_iso)
+        self.__profiles__[key] = (digest, sma_list, out_list)
+        return sma_list, out_list, True
+
+    def __draw_1Dpro__(self, sma_list, out_list, axs, types, label=None, is_origin=False):
         for ax, type in zip(axs, types):
             if is_origin:
                 ax.errorbar(sma_list, out_list[type], out_list[type+'_err'], fmt='o',
@@ -107,57 +181,87 @@ class GalfitPlot:
                 ax.plot(sma_list, out_list[type],
                         label=label, linestyle='--', linewidth=0.5)
 
-        if show_iso:
-            fig = plt.figure()
-            ax = fig.add_subplot()
-            self.__plot_model__(hdu, ax, cut_coeff=99.5)
-            for i in range(5, len(sma_list), 5):
-                aper = EllipticalAperture((isolist.x0[i], isolist.y0[i]),
-                                          isolist.sma[i], isolist.sma[i] *
-                                          (1 - isolist.eps[i]),
-                                          isolist.pa[i])
-                aper.plot(ax)
-            fig.savefig('iso.pdf', format='pdf')
-            # fig.show()
+    def __analytic_profiles__(self, sma_list):
+        # unconvolved major-axis profiles of the fitted components, on the radii of the data isophotes
+        r = sma_list / self.__pixel_scale__
+        curves = []
+        for i, component in enumerate(self.__fitted_components__):
+            if component.__type__ in ('sky', 'psf'):
+                continue
+            intens = major_axis_profile(component, r, self.__zeropoint__, self.__pixel_scale__)
+            # truncated profiles (ferrer, king) are 0 outside, left out of the curve
+            intens = np.where(intens > 0, intens, np.nan)
+            mu = -2.5 * np.log10(intens) + self.__zeropoint__
+            curves.append((sma_list, {'mu': mu}, ['mu'], component.__type__+str(i), False))
+        return curves
 
-    def plot(self, cut_coeff=99.5, pro_1D=True):
-        fig = plt.figure(figsize=(7, 7))
-        gs = GridSpec(3, 2, figure=fig, hspace=0, wspace=0)
-        axs = np.array([[fig.add_subplot(gs[i, j])
-                       for j in range(2)] for i in range(3)])
-        with fits.open(self.__model__) as model:
-            for hdu in model[1:]:
-                type = hdu.header['OBJECT']
-
-                type.strip()
-                if type == 'model':
-                    print(f'Working on {type}')
-                    self.__plot_model__(hdu, axs[1, 1], cut_coeff=cut_coeff)
-                    if pro_1D:
-                        self.__plot_1Dpro__(
-                            hdu, axs[:, 0], ['eps', 'pa', 'mu'], label='model')
-                elif type == 'residual map':
-                    print(f'Working on {type}')
-                    self.__plot_model__(hdu, axs[2, 1], cut_coeff=cut_coeff)
-                else:
-                    print(f'Working on original data')
-                    self.__plot_model__(
-                        hdu, axs[0, 1], cut_coeff=cut_coeff, is_origin=True)
-                    if pro_1D:
-                        self.__plot_1Dpro__(
-                            hdu, axs[:, 0], ['eps', 'pa', 'mu'], label='origin', is_origin=True, show_iso=True)
-
-        if self.__components__ is not None and pro_1D:
-            with fits.open(self.__components__) as comps:
-                for i, hdu in enumerate(comps[1:]):
-                    type = hdu.header['OBJECT']
-                    type.strip()
-                    if type == 'sky':
-                        continue
-                    if type in component_names:
-                        self.__plot_1Dpro__(
-                            hdu, axs[2:, 0], ['mu'], label=type+str(i), 
-                            is_comp=True)
+    def __plot_1Dpro__(self, data, axs, types, label=None, is_origin=False, 
+                       is_comp=False, show_iso=False):
+        sma_list, out_list = self.__isophotes__(data, is_origin, is_comp, show_iso)
+        self.__draw_1Dpro__(sma_list, out_list, axs, types, label, is_origin)
+
+    def plot(self, cut_coeff=99.5, pro_1D=True, analytic=True):
+        """
+        Draw the data, model and residual panels and the 1D profiles, and save the figure
+        The figure is kept: called again after a new fit, only the panels and profiles whose inputs
+        changed are redone (usually the model, residual and components, not the data).
+        :param analytic: bool, with fitted_components, draw the component profiles from their parameters
+                         (unconvolved, major axis) instead of fitting isophotes to the component images
+        """
+        self.refresh()
+        if self.__figure__ is None:
+            fig = plt.figure(figsize=(7, 7))
+            gs = gridspec.GridSpec(3, 2, figure=fig, hspace=0, wspace=0)
+            axs = np.array([[fig.add_subplot(gs[i, j])
+                           for j in range(2)] for i in range(3)])
+            self.__figure__ = (fig, axs)
+        fig, axs = self.__figure__
+        profiles = []
+        for hdu in self.__result__.cube[1:]:
+            type = hdu.header['OBJECT'].strip()
+            if type == 'model':
+                self.__panel__('model', hdu.data, axs[1, 1], cut_coeff)
+                if pro_1D:
+                    profiles.append(('model', hdu.data, ['eps', 'pa', 'mu'], False, False))
+            elif type == 'residual map':
+                self.__panel__('residual', hdu.data, axs[2, 1], cut_coeff)
+            else:
+                # compacted outputs may keep only a pointer to the input image
+                data = self.__result__.data
+                self.__panel__('data', data, axs[0, 1], cut_coeff, is_origin=True)
+                if pro_1D:
+                    profiles.insert(0, ('origin', data, ['eps', 'pa', 'mu'], True, False))
+
+        analytic = analytic and self.__fitted_components__ is not None
+        if pro_1D and not analytic:
+            for i, (type, data) in enumerate(self.__result__.component_images):
+                if type == 'sky':
+                    continue
+                if type in component_names:
+                    profiles.append((type+str(i), data, ['mu'], False, True))
+
+        if pro_1D:
+            curves = []
+            drawn = [p[0] for p in profiles]
+            if analytic:
+                drawn.append([c.__getstate__() for c in self.__fitted_components__])
+            changed = self.__drawn__.get('profiles') != drawn
+            for label, data, types, is_origin, is_comp in profiles:
+                sma_list, out_list, fitted = self.__profile__(label, data, is_origin, is_comp,
+                                                              show_iso=is_origin)
+                curves.append((sma_list, out_list, types, label, is_origin))
+                changed |= fitted
+            if analytic and curves:
+                curves.extend(self.__analytic_profiles__(curves[0][0]))
+            if changed:
+                for ax in axs[:, 0]:
+                    ax.clear()
+                for sma_list, out_list, types, label, is_origin in curves:
+                    self.__draw_1Dpro__(sma_list, out_list, axs[3 - len(types):, 0], types, label, is_origin)
+                self.__drawn__['profiles'] = drawn
+            if self.__state_file__ is not None:
+                with open(self.__state_file__, 'wb') as file:
+                    pickle.dump(self.__profiles__, file)
 
         axs[2, 0].legend()
         axs[0, 0].set_ylabel('$\epsilon$')
@@ -219,14 +323,15 @@ class GalfitPlot:
     #     plt.savefig(fig_file, format='pdf')
 
     def plot_comps(self, cut_coeff=99.5):
-        if self.__components__ is None:
+        self.refresh()
+        comps = self.__result__.components
+        if comps is None:
             return
-        with fits.open(self.__components__) as comps:
-            length = len(comps)
-            fig, ax = plt.subplots(1, length)
-            for i, hdu in enumerate(comps):
-                self.__plot_model__(hdu, ax[i], cut_coeff=cut_coeff)
-            plt.legend()
-            # plt.show()
-            fig_file = self.__model__.replace('.fits', '_comps.pdf')
-            plt.savefig(fig_file, format='pdf')
+        length = len(comps)
+        fig, ax = plt.subplots(1, length)
+        for i, hdu in enumerate(comps):
+            self.__plot_model__(hdu.data, ax[i], cut_coeff=cut_coeff, key=('component', i))
+        plt.legend()
+        # plt.show()
+        fig_file = self.__model__.replace('.fits', '_comps.pdf')
+        plt.savefig(fig_file, format='pdf')
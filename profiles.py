@@ -0,0 +1,388 @@
+import numpy as np
+from lazy_import import LazyModule
+
+special = LazyModule('scipy.special')
+
+LN10 = np.log(10)
+FWHM_TO_SIGMA = 1 / (2 * np.sqrt(2 * np.log(2)))
+# radii are sampled at pixel centres, keep them off zero so the cuspy profiles stay finite
+R_MIN = 1e-8
+
+
+def sersic_bn(n):
+    """
+    Sersic b_n such that Re encloses half of the light
+    Ciotti & Bertin (1999) expansion for n > 0.36, MacArthur et al. (2003) polynomial below
+    :param n: float or array, Sersic index
+    :return: b_n, same shape as n
+    """
+    n = np.asarray(n, dtype=float)
+    large = 2 * n - 1 / 3 + 4 / (405 * n) + 46 / (25515 * n**2) + \
+        131 / (1148175 * n**3) - 2194697 / (30690717750 * n**4)
+    small = 0.01945 - 0.8902 * n + 10.95 * n**2 - 19.67 * n**3 + 13.43 * n**4
+    return np.where(n > 0.36, large, small)
+
+
+def sersic_bn_derivative(n):
+    """
+    Derivative of sersic_bn with respect to n
+    :param n: float or array, Sersic index
+    :return: d b_n / d n, same shape as n
+    """
+    n = np.asarray(n, dtype=float)
+    large = 2 - 4 / (405 * n**2) - 92 / (25515 * n**3) - \
+        393 / (1148175 * n**4) + 4 * 2194697 / (30690717750 * n**5)
+    small = -0.8902 + 21.9 * n - 59.01 * n**2 + 53.72 * n**3
+    return np.where(n > 0.36, large, small)
+
+
+def pixel_grid(shape, origin=(1, 1)):
+    """
+    Pixel centre coordinates in the GALFIT (1-based) convention
+    :param shape: tuple, (ny, nx) of the image
+    :param origin: tuple, (x, y) coordinate of the array element [0, 0]
+    :return: x, y arrays of the given shape
+    """
+    ny, nx = shape
+    y, x = np.mgrid[0:ny, 0:nx].astype(float)
+    return x + origin[0], y + origin[1]
+
+
+def _rotate(x, y, x0, y0, pa):
+    # u along the major axis (PA: Up=0, Left=90), v along the minor axis
+    theta = np.radians(pa)
+    dx, dy = x - x0, y - y0
+    u = -dx * np.sin(theta) + dy * np.cos(theta)
+    v = -dx * np.cos(theta) - dy * np.sin(theta)
+    return u, v, theta
+
+
+def elliptical_radius(x, y, x0, y0, q=1., pa=0.):
+    """
+    Semi-major axis of the ellipse through each pixel, GALFIT geometry
+    :param x, y: arrays, pixel coordinates, see pixel_grid
+    :param x0, y0: float, centre [pixels]
+    :param q: float, axis ratio b/a
+    :param pa: float, position angle [degrees: Up=0, Left=90]
+    :return: array of radii [pixels]
+    """
+    u, v, _ = _rotate(x, y, x0, y0, pa)
+    return np.sqrt(u**2 + (v / q) ** 2)
+
+
+def _flux(magnitude, zeropoint):
+    return 10 ** (-0.4 * (magnitude - zeropoint))
+
+
+def _pixel_brightness(mu, zeropoint, pixel_scale):
+    return pixel_scale**2 * 10 ** (-0.4 * (mu - zeropoint))
+
+
+def _sersic(r, magnitude, re, n, q, zeropoint):
+    kappa = sersic_bn(n)
+    dkappa = sersic_bn_derivative(n)
+    ln_x = np.log(r / re)
+    s = np.exp(ln_x / n)
+    ln_norm = np.log(_flux(magnitude, zeropoint)) - np.log(2 * np.pi) - 2 * np.log(re) - \
+        np.log(n) + 2 * n * np.log(kappa) - special.gammaln(2 * n) - np.log(q)
+    image = np.exp(ln_norm - kappa * s)
+    partials = {
+        'magnitude': -0.4 * LN10 * image,
+        'effective_radius': image * (-2 / re + kappa * s / (n * re)),
+        'sersic_index': image * (-1 / n + 2 * np.log(kappa) + 2 * n * dkappa / kappa -
+                                 2 * special.digamma(2 * n) - dkappa * s + kappa * s * ln_x / n**2),
+        'axis_ratio': -image / q,
+    }
+    return image, -image * kappa * s / (n * r), partials
+
+
+def _sersic_profile(r, c, zeropoint, pixel_scale):
+    return _sersic(r, c.magnitude, c.effective_radius, c.sersic_index, c.axis_ratio, zeropoint)
+
+
+def _devauc_profile(r, c, zeropoint, pixel_scale):
+    image, d_r, partials = _sersic(r, c.magnitude, c.effective_radius, 4., c.axis_ratio, zeropoint)
+    partials.pop('sersic_index')
+    return image, d_r, partials
+
+
+def _expdisk_profile(r, c, zeropoint, pixel_scale):
+    rs, q = c.effective_radius, c.axis_ratio
+    image = _flux(c.magnitude, zeropoint) / (2 * np.pi * rs**2 * q) * np.exp(-r / rs)
+    partials = {
+        'magnitude': -0.4 * LN10 * image,
+        'effective_radius': image * (-2 / rs + r / rs**2),
+        'axis_ratio': -image / q,
+    }
+    return image, -image / rs, partials
+
+
+def _gaussian_profile(r, c, zeropoint, pixel_scale):
+    sigma, q = c.fwhm * FWHM_TO_SIGMA, c.axis_ratio
+    image = _flux(c.magnitude, zeropoint) / (2 * np.pi * sigma**2 * q) * np.exp(-r**2 / (2 * sigma**2))
+    partials = {
+        'magnitude': -0.4 * LN10 * image,
+        'fwhm': image * (-2 / sigma + r**2 / sigma**3) * FWHM_TO_SIGMA,
+        'axis_ratio': -image / q,
+    }
+    return image, -image * r / sigma**2, partials
+
+
+def _moffat_profile(r, c, zeropoint, pixel_scale):
+    beta, q = c.power_law, c.axis_ratio
+    g = 2 ** (1 / beta) - 1
+    rd = c.fwhm / (2 * np.sqrt(g))
+    w = 1 + (r / rd) ** 2
+    image = _flux(c.magnitude, zeropoint) * (beta - 1) / (np.pi * rd**2 * q) * w ** (-beta)
+    d_rd = image * (-2 / rd + 2 * beta * r**2 / (rd**3 * w))
+    partials = {
+        'magnitude': -0.4 * LN10 * image,
+        'fwhm': d_rd * rd / c.fwhm,
+        'power_law': image * (1 / (beta - 1) - np.log(w)) +
+        d_rd * rd * 2 ** (1 / beta) * np.log(2) / (2 * g * beta**2),
+        'axis_ratio': -image / q,
+    }
+    return image, -image * 2 * beta * r / (rd**2 * w), partials
+
+
+def _ferrer_profile(r, c, zeropoint, pixel_scale):
+    rout, alpha, beta = c.outer_truncation_radius, c.alpha, c.beta
+    inside = r < rout
+    x = np.where(inside, r / rout, 0.5)
+    t = x ** (2 - beta)
+    w = 1 - t
+    sigma0 = _pixel_brightness(c.central_surface_brightness, zeropoint, pixel_scale)
+    image = np.where(inside, sigma0 * w**alpha, 0.)
+    slope = np.where(inside, sigma0 * alpha * w ** (alpha - 1), 0.)
+    partials = {
+        'central_surface_brightness': -0.4 * LN10 * image,
+        'outer_truncation_radius': slope * (2 - beta) * t / rout,
+        'alpha': np.where(inside, image * np.log(w), 0.),
+        'beta': slope * t * np.log(x),
+    }
+    return image, -slope * (2 - beta) * t / r, partials
+
+
+def _nuker_profile(r, c, zeropoint, pixel_scale):
+    rb, alpha, beta, gamma = c.break_radius, c.alpha, c.beta, c.gamma
+    x = r / rb
+    xa = x**alpha
+    ln_w = np.log1p(xa)
+    ib = _pixel_brightness(c.surface_brightness, zeropoint, pixel_scale)
+    image = ib * 2 ** ((beta - gamma) / alpha) * x ** (-gamma) * np.exp((gamma - beta) / alpha * ln_w)
+    d_x = image * (-gamma / x + (gamma - beta) * xa / (x * (1 + xa)))
+    partials = {
+        'surface_brightness': -0.4 * LN10 * image,
+        'break_radius': -d_x * x / rb,
+        'alpha': image * (-(beta - gamma) * np.log(2) / alpha**2 - (gamma - beta) * ln_w / alpha**2 +
+                          (gamma - beta) / alpha * xa * np.log(x) / (1 + xa)),
+        'beta': image * (np.log(2) - ln_w) / alpha,
+        'gamma': image * (-np.log(2) / alpha - np.log(x) + ln_w / alpha),
+    }
+    return image, d_x / rb, partials
+
+
+def _king_profile(r, c, zeropoint, pixel_scale):
+    # empirical King: sigma0 ((a - b) / (1 - b))^alpha, a = (1 + (r/rc)^2)^(-1/alpha), b the same at rt
+    rc, rt, alpha = c.core_radius, c.tidal_radius, c.alpha
+    inside = r < rt
+    wr = 1 + (r / rc) ** 2
+    wt = 1 + (rt / rc) ** 2
+    a = wr ** (-1 / alpha)
+    b = wt ** (-1 / alpha)
+    q = 1 - b
+    g = np.where(inside, (a - b) / q, 0.)
+    sigma0 = _pixel_brightness(c.central_surface_brightness, zeropoint, pixel_scale)
+    image = sigma0 * g**alpha
+    # dI/dg, zero outside the tidal radius; dg/da = 1 / q, dg/db = (a - 1) / q^2
+    d_g = np.where(inside, sigma0 * alpha * np.where(inside, g, 1.) ** (alpha - 1), 0.)
+    d_a = d_g / q
+    d_b = d_g * (a - 1) / q**2
+    ln_g = np.log(np.where(inside & (g > 0), g, 1.))
+    partials = {
+        'central_surface_brightness': -0.4 * LN10 * image,
+        'core_radius': d_a * a * 2 * r**2 / (alpha * rc**3 * wr) +
+        d_b * b * 2 * rt**2 / (alpha * rc**3 * wt),
+        'tidal_radius': d_b * b * (-2 * rt) / (alpha * rc**2 * wt),
+        'alpha': image * ln_g + d_a * a * np.log(wr) / alpha**2 + d_b * b * np.log(wt) / alpha**2,
+    }
+    return image, d_a * a * (-2 * r) / (alpha * rc**2 * wr), partials
+
+
+__profiles__ = {'sersic': _sersic_profile, 'devauc': _devauc_profile, 'expdisk': _expdisk_profile,
+                'gaussian': _gaussian_profile, 'moffat': _moffat_profile, 'ferrer': _ferrer_profile,
+                'nuker': _nuker_profile, 'king': _king_profile}
+
+__parameter_names__ = {
+    'sersic': ['x', 'y', 'magnitude', 'effective_radius', 'sersic_index', 'axis_ratio', 'position_angle'],
+    'devauc': ['x', 'y', 'magnitude', 'effective_radius', 'axis_ratio', 'position_angle'],
+    'expdisk': ['x', 'y', 'magnitude', 'effective_radius', 'axis_ratio', 'position_angle'],
+    'gaussian': ['x', 'y', 'magnitude', 'fwhm', 'axis_ratio', 'position_angle'],
+    'moffat': ['x', 'y', 'magnitude', 'fwhm', 'power_law', 'axis_ratio', 'position_angle'],
+    'ferrer': ['x', 'y', 'central_surface_brightness', 'outer_truncation_radius', 'alpha', 'beta',
+               'axis_ratio', 'position_angle'],
+    'nuker': ['x', 'y', 'surface_brightness', 'break_radius', 'alpha', 'beta', 'gamma',
+              'axis_ratio', 'position_angle'],
+    'king': ['x', 'y', 'central_surface_brightness', 'core_radius', 'tidal_radius', 'alpha',
+             'axis_ratio', 'position_angle'],
+    'edgedisk': ['x', 'y', 'central_surface_brightness', 'scale_height', 'scale_length', 'position_angle'],
+    'psf': ['x', 'y', 'magnitude'],
+    'sky': ['background', 'gradient_x', 'gradient_y'],
+}
+
+
+def parameter_names(component):
+    """
+    Names of the parameters a component profile depends on, in GALFIT order
+    :param component: Component
+    :return: list of str, 'x' and 'y' stand for the two halves of the position
+    """
+    return list(__parameter_names__[component.__type__])
+
+
+def get_parameter(component, name):
+    if name == 'x':
+        return component.position[0]
+    if name == 'y':
+        return component.position[1]
+    return getattr(component, name)
+
+
+def set_parameter(component, name, value):
+    if name == 'x':
+        component.position = (value, component.position[1])
+    elif name == 'y':
+        component.position = (component.position[0], value)
+    else:
+        setattr(component, name, value)
+
+
+def is_trainable(component, name):
+    if name == 'x':
+        return bool(component.__position__.trainable[0])
+    if name == 'y':
+        return bool(component.__position__.trainable[1])
+    return bool(getattr(component, f'__{name}__').trainable)
+
+
+def _anisotropic_jacobian(component, x, y, zeropoint, pixel_scale):
+    x0, y0 = component.position
+    q = component.axis_ratio
+    u, v, theta = _rotate(x, y, x0, y0, component.position_angle)
+    r = np.maximum(np.sqrt(u**2 + (v / q) ** 2), R_MIN)
+    image, d_r, partials = __profiles__[component.__type__](r, component, zeropoint, pixel_scale)
+    # geometry: du/dx0 = sin, dv/dx0 = cos, du/dy0 = -cos, dv/dy0 = sin, du/dtheta = v, dv/dtheta = -u
+    dr_du = u / r
+    dr_dv = v / (q**2 * r)
+    jacobian = {
+        'x': d_r * (dr_du * np.sin(theta) + dr_dv * np.cos(theta)),
+        'y': d_r * (-dr_du * np.cos(theta) + dr_dv * np.sin(theta)),
+        'position_angle': d_r * u * v * (1 - 1 / q**2) / r * np.pi / 180,
+    }
+    jacobian.update(partials)
+    jacobian['axis_ratio'] = jacobian.get('axis_ratio', 0.) - d_r * v**2 / (q**3 * r)
+    return image, jacobian
+
+
+def _sech2(z):
+    e = np.exp(-2 * np.abs(z))
+    return 4 * e / (1 + e) ** 2
+
+
+def _edgedisk_jacobian(component, x, y, zeropoint, pixel_scale):
+    x0, y0 = component.position
+    hs, rs = component.scale_height, component.scale_length
+    u, v, theta = _rotate(x, y, x0, y0, component.position_angle)
+    z = np.maximum(np.abs(u) / rs, R_MIN)
+    g = z * special.k1(z)
+    dg = -z * special.k0(z)
+    h = v / hs
+    sech2 = _sech2(h)
+    sigma0 = _pixel_brightness(component.central_surface_brightness, zeropoint, pixel_scale)
+    image = sigma0 * g * sech2
+    d_u = sigma0 * dg * sech2 * np.sign(u) / rs
+    d_v = -2 * image * np.tanh(h) / hs
+    jacobian = {
+        'x': d_u * np.sin(theta) + d_v * np.cos(theta),
+        'y': -d_u * np.cos(theta) + d_v * np.sin(theta),
+        'central_surface_brightness': -0.4 * LN10 * image,
+        'scale_height': -d_v * h,
+        'scale_length': -sigma0 * dg * sech2 * z / rs,
+        'position_angle': (d_u * v - d_v * u) * np.pi / 180,
+    }
+    return image, jacobian
+
+
+def _sky_jacobian(component, x, y, zeropoint, pixel_scale):
+    xc = (x.min() + x.max()) / 2
+    yc = (y.min() + y.max()) / 2
+    image = component.background + component.gradient_x * (x - xc) + component.gradient_y * (y - yc)
+    jacobian = {'background': np.ones_like(image), 'gradient_x': x - xc, 'gradient_y': y - yc}
+    return image, jacobian
+
+
+def model_jacobian(component, shape, zeropoint=0, pixel_scale=1, origin=(1, 1)):
+    """
+    Evaluate the unconvolved component image and its analytic partial derivatives
+    :param component: Component, any type in component_names except psf
+    :param shape: tuple, (ny, nx) of the pixel grid
+    :param zeropoint: float, magnitude zeropoint (image units are counts, exposure time 1)
+    :param pixel_scale: float, pixel size [arcsec], used by the surface-brightness parameters
+    :param origin: tuple, (x, y) coordinate of the array element [0, 0]
+    :return: image, dict of parameter name -> d image / d parameter (see parameter_names)
+    """
+    x, y = pixel_grid(shape, origin)
+    type = component.__type__
+    if type == 'sky':
+        image, jacobian = _sky_jacobian(component, x, y, zeropoint, pixel_scale)
+    elif type == 'edgedisk':
+        image, jacobian = _edgedisk_jacobian(component, x, y, zeropoint, pixel_scale)
+    elif type in __profiles__:
+        image, jacobian = _anisotropic_jacobian(component, x, y, zeropoint, pixel_scale)
+    else:
+        raise ValueError(f'No analytic profile for component type {type}')
+    return image, {name: np.broadcast_to(jacobian[name], shape) for name in parameter_names(component)}
+
+
+def model_image(component, shape, zeropoint=0, pixel_scale=1, origin=(1, 1)):
+    """
+    Evaluate the unconvolved component image, see model_jacobian
+    """
+    return model_jacobian(component, shape, zeropoint, pixel_scale, origin)[0]
+
+
+def major_axis_profile(component, r, zeropoint=0, pixel_scale=1):
+    """
+    Unconvolved intensity along the major axis, from the component parameters
+    :param component: Component, a type in __profiles__ or edgedisk
+    :param r: array, distances from the centre along the major axis [pixels]
+    :param zeropoint, pixel_scale: see model_jacobian
+    :return: array, intensity per pixel, same shape as r
+    """
+    r = np.maximum(np.asarray(r, dtype=float), R_MIN)
+    type = component.__type__
+    if type == 'edgedisk':
+        z = r / component.scale_length
+        return _pixel_brightness(component.central_surface_brightness, zeropoint, pixel_scale) * z * special.k1(z)
+    if type not in __profiles__:
+        raise ValueError(f'No analytic profile for component type {type}')
+    return __profiles__[type](r, component, zeropoint, pixel_scale)[0]
+
+
+def numerical_jacobian(component, shape, zeropoint=0, pixel_scale=1, origin=(1, 1), step=1e-6):
+    """
+    Central finite-difference jacobian, used to check model_jacobian
+    :param step: float, relative step size (absolute where the parameter is 0)
+    :return: dict of parameter name -> d image / d parameter
+    """
+    jacobian = {}
+    for name in parameter_names(component):
+        value = get_parameter(component, name)
+        h = step * max(abs(value), 1.)
+        set_parameter(component, name, value + h)
+        upper = model_image(component, shape, zeropoint, pixel_scale, origin)
+        set_parameter(component, name, value - h)
+        lower = model_image(component, shape, zeropoint, pixel_scale, origin)
+        set_parameter(component, name, value)
+        jacobian[name] = (upper - lower) / (2 * h)
+    return jacobian
@@ -0,0 +1,149 @@
+import functools
+import os
+import numpy as np
+from task import *
+from lazy_import import LazyModule
+
+spatial = LazyModule('scipy.spatial')
+table = LazyModule('astropy.table')
+
+# decoded stamps kept in memory, shared by all libraries of the process
+CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _load_stamp(path, ext, mtime, size):
+    stamp = fits.getdata(path, ext).astype(float)
+    stamp /= stamp.sum()
+    stamp.setflags(write=False)
+    return stamp
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _stamp_header(path, ext, mtime, size):
+    return fits.getheader(path, ext)
+
+
+def _file_key(file_name, ext):
+    # a rewritten file (new mtime or size) is decoded again
+    path = os.path.abspath(file_name)
+    stat = os.stat(path)
+    return path, ext, stat.st_mtime_ns, stat.st_size
+
+
+def load_stamp(file_name, ext=0):
+    """
+    PSF stamp normalized to unit sum, decoded once per process and file version
+    :return: read-only 2D array, shared by every caller
+    """
+    return _load_stamp(*_file_key(file_name, ext))
+
+
+def stamp_header(file_name, ext=0):
+    """
+    Header of a PSF stamp, read once per process and file version; do not modify it
+    """
+    return _stamp_header(*_file_key(file_name, ext))
+
+
+def _unit_vectors(ra, dec):
+    # sky positions as points on the unit sphere, so the tree distance is monotonic in the angle
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+class PSFLibrary:
+    def __init__(self, files, positions, exts=None, sky=False):
+        """
+        PSF stamps indexed by position with a KD-tree
+        :param files: list of str, stamp files
+        :param positions: (N, 2) array, pixel (x, y) or sky (ra, dec) [degrees] of each stamp
+        :param exts: list of int, HDU of each stamp, the primary HDU by default
+        :param sky: bool, positions are (ra, dec)
+        """
+        self.__files__ = [os.path.abspath(f) for f in files]
+        self.__exts__ = list(exts) if exts is not None else [0] * len(self.__files__)
+        self.__positions__ = np.asarray(positions, dtype=float).reshape(-1, 2)
+        self.__sky__ = sky
+        points = _unit_vectors(*self.__positions__.T) if sky else self.__positions__
+        self.__tree__ = spatial.cKDTree(points)
+
+    @classmethod
+    def from_table(cls, table_file, sky=False):
+        """
+        :param table_file: str, any table astropy reads, with columns psf_file and x, y (or ra, dec if sky),
+                           optionally ext
+        :return: PSFLibrary
+        """
+        t = table.Table.read(table_file)
+        names = ('ra', 'dec') if sky else ('x', 'y')
+        exts = list(t['ext']) if 'ext' in t.colnames else None
+        return cls([str(f) for f in t['psf_file']], np.column_stack([t[n] for n in names]), exts, sky)
+
+    def __len__(self):
+        return len(self.__files__)
+
+    @property
+    def positions(self):
+        return self.__positions__
+
+    def nearest(self, position, k=1):
+        """
+        :param position: (x, y) or (ra, dec)
+        :param k: int, number of stamps
+        :return: (list of int, array), indices of the k nearest stamps and their distances
+                 (pixels, or chord length on the unit sphere for sky positions)
+        """
+        k = min(k, len(self))
+        point = _unit_vectors(*np.reshape(position, (2, 1)))[0] if self.__sky__ else np.asarray(position, float)
+        distances, indices = self.__tree__.query(point, k=k)
+        return [int(i) for i in np.atleast_1d(indices)], np.atleast_1d(distances)
+
+    def stamp(self, index):
+        return load_stamp(self.__files__[index], self.__exts__[index])
+
+    def psf(self, position, k=1, power=2):
+        """
+        PSF at a position: the nearest stamp, or the inverse-distance weighted mean of the k nearest
+        :param k: int, number of stamps interpolated, they must have the same shape
+        :param power: float, weights are distance ** -power
+        :return: 2D array normalized to unit sum; read-only if it is a cached stamp
+        """
+        indices, distances = self.nearest(position, k)
+        if len(indices) == 1 or distances[0] == 0:
+            return self.stamp(indices[0])
+        weights = distances ** -power
+        psf = sum(w * self.stamp(i) for w, i in zip(weights / weights.sum(), indices))
+        return psf / psf.sum()
+
+    def psf_file(self, position, output_file=None, k=1, power=2):
+        """
+        PSF file for GALFIT at a position: the nearest stamp file as is for k = 1, else the interpolated
+        stamp written with the header of the nearest stamp (SCALE, ...)
+        GALFIT only reads primary HDUs, so a nearest stamp in another extension is written out as well.
+        :param output_file: str, file of the interpolated or extracted stamp, needed in those two cases
+        :return: str
+        """
+        indices, distances = self.nearest(position, k)
+        nearest = indices[0]
+        single = len(indices) == 1 or distances[0] == 0
+        if single and self.__exts__[nearest] == 0:
+            return self.__files__[nearest]
+        if output_file is None:
+            reason = f'a stamp in extension {self.__exts__[nearest]}' if single else 'an interpolated PSF'
+            raise ValueError(f'output_file is needed to write {reason}')
+        header = stamp_header(self.__files__[nearest], self.__exts__[nearest])
+        psf = self.stamp(nearest) if single else self.psf(position, k, power)
+        fits.writeto(output_file, psf.astype(np.float32), header, overwrite=True)
+        return output_file
+
+    def set_psf(self, config: Config, position, output_file=None, k=1, power=2):
+        """
+        Point a config to the PSF at a position, with the convolution box and sampling factor of the stamp
+        """
+        config.psf_file = self.psf_file(position, output_file, k, power)
+        nearest = self.nearest(position)[0][0]
+        ny, nx = self.stamp(nearest).shape
+        config.convolution_size = (nx, ny)
+        config.__psf_scale__.value = read_header(stamp_header(self.__files__[nearest], self.__exts__[nearest]),
+                                                 'SCALE')
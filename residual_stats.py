@@ -0,0 +1,130 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from lazy_import import LazyModule
+from profiles import pixel_grid, elliptical_radius
+from fit_result import FitResult
+
+fits = LazyModule('astropy.io.fits')
+ndimage = LazyModule('scipy.ndimage')
+table = LazyModule('astropy.table')
+
+# elliptical aperture in GALFIT image coordinates, sma in pixels, pa in degrees (Up=0, Left=90)
+Aperture = namedtuple('Aperture', ['x0', 'y0', 'sma', 'q', 'pa'], defaults=[1., 0.])
+
+METRICS = ['npix', 'chi2nu', 'rff', 'asymmetry', 'smoothness']
+
+
+def robust_std(values):
+    values = values[np.isfinite(values)]
+    return 1.4826 * np.median(np.abs(values - np.median(values)))
+
+
+def aperture_statistics(data, residual, aperture, sigma=None, good=None, origin=(1, 1),
+                        smooth_size=None):
+    """
+    Residual statistics inside one elliptical aperture, vectorized over the pixels
+    :param data, residual: 2D arrays of the fitted region
+    :param aperture: Aperture
+    :param sigma: 2D array or float, pixel noise; robust std of the residual if None
+    :param good: 2D bool array, pixels to use, all finite pixels if None
+    :param origin: tuple, (x, y) image coordinate of the array element [0, 0]
+    :param smooth_size: int, boxcar size of the smoothness statistic, a quarter of the sma by default
+    :return: dict with
+             npix: number of pixels used
+             chi2nu: sum((residual / sigma)^2) / npix
+             rff: residual flux fraction, (sum|residual| - 0.8 sum(sigma)) / sum(data)
+             asymmetry: sum|residual - residual rotated by 180 deg about the centre| / sum|data|
+             smoothness: sum|residual - smoothed residual| / sum|data|
+    """
+    if good is None:
+        good = np.isfinite(data) & np.isfinite(residual)
+    if sigma is None:
+        sigma = robust_std(residual[good])
+    sigma = np.broadcast_to(sigma, data.shape)
+    x, y = pixel_grid(data.shape, origin)
+    inside = good & (elliptical_radius(x, y, aperture.x0, aperture.y0, aperture.q, aperture.pa) <= aperture.sma)
+    npix = int(inside.sum())
+    if npix == 0:
+        return {name: np.nan for name in METRICS} | {'npix': 0}
+    res = residual[inside]
+    flux = np.sum(np.abs(data[inside]))
+    # residual map rotated by 180 degrees about the aperture centre, bilinear
+    rows = 2 * (aperture.y0 - origin[1]) - (y[inside] - origin[1])
+    cols = 2 * (aperture.x0 - origin[0]) - (x[inside] - origin[0])
+    filled = np.where(good, residual, 0.)
+    rotated = ndimage.map_coordinates(filled, [rows, cols], order=1, mode='constant', cval=0.)
+    smooth_size = smooth_size or max(3, int(round(aperture.sma / 4)))
+    smoothed = ndimage.uniform_filter(filled, size=smooth_size, mode='constant')[inside]
+    return {'npix': npix,
+            'chi2nu': float(np.sum((res / sigma[inside]) ** 2) / npix),
+            'rff': float((np.sum(np.abs(res)) - 0.8 * np.sum(sigma[inside])) / np.sum(data[inside])),
+            'asymmetry': float(np.sum(np.abs(res - rotated)) / flux),
+            'smoothness': float(np.sum(np.abs(res - smoothed)) / flux)}
+
+
+def residual_statistics(output_file, apertures=None, sigma_file='none', mask_file='none', smooth_size=None):
+    """
+    Read a GALFIT output cube once (memory-mapped) and compute the residual statistics in each aperture
+    :param output_file: str, GALFIT output cube (input, model and residual HDUs), or a FitResult
+    :param apertures: list of Aperture, the whole fitted region if None
+    :param sigma_file: str, sigma image of the full input frame, 'none' to estimate the noise from the residual
+    :param mask_file: str, mask of the input frame (non-zero = bad), 'none' for no mask; a FitResult uses its own
+    :param smooth_size: int, see aperture_statistics
+    :return: list of dict, one per aperture, see aperture_statistics
+    """
+    if isinstance(output_file, FitResult):
+        return _residual_statistics(output_file, apertures, sigma_file, smooth_size)
+    with FitResult(output_file, mask_file) as result:
+        return _residual_statistics(result, apertures, sigma_file, smooth_size)
+
+
+def _residual_statistics(result, apertures, sigma_file, smooth_size):
+    data, residual = result.data, result.residual
+    origin = result.origin
+    ny, nx = data.shape
+    good = np.isfinite(data) & np.isfinite(residual)
+    if result.mask is not None:
+        good &= result.mask == 0
+    sigma = None
+    if sigma_file != 'none':
+        section = (slice(origin[1] - 1, origin[1] - 1 + ny), slice(origin[0] - 1, origin[0] - 1 + nx))
+        sigma = fits.getdata(sigma_file)[section].astype(float)
+        good &= sigma > 0
+    if apertures is None:
+        apertures = [Aperture(origin[0] + (nx - 1) / 2, origin[1] + (ny - 1) / 2, np.hypot(nx, ny))]
+    return [aperture_statistics(data, residual, aperture, sigma, good, origin, smooth_size)
+            for aperture in apertures]
+
+
+def residual_statistics_batch(output_files, apertures=None, table_file=None, max_workers=None, **kwargs):
+    """
+    Residual statistics of many outputs, collected in a single table
+    :param output_files: list of str
+    :param apertures: list of Aperture shared by all outputs, or a function output_file -> list of Aperture
+    :param table_file: str, written with astropy (format from the extension: .fits, .ecsv, .csv, ...)
+    :param max_workers: int, number of threads
+    :param kwargs: passed on to residual_statistics
+    :return: astropy.table.Table, one row per output and aperture, NaN for unreadable outputs
+    """
+    def measure(output_file):
+        try:
+            apers = apertures(output_file) if callable(apertures) else apertures
+            return residual_statistics(output_file, apers, **kwargs)
+        except (OSError, IndexError, KeyError):
+            return [{name: np.nan for name in METRICS} | {'npix': 0}]
+
+    output_files = list(output_files)
+    with ThreadPoolExecutor(max_workers) as executor:
+        results = list(executor.map(measure, output_files))
+    rows = {'output_file': [], 'aperture': []} | {name: [] for name in METRICS}
+    for output_file, stats in zip(output_files, results):
+        for k, stat in enumerate(stats):
+            rows['output_file'].append(output_file)
+            rows['aperture'].append(k)
+            for name in METRICS:
+                rows[name].append(stat[name])
+    result = table.Table(rows)
+    if table_file is not None:
+        result.write(table_file, overwrite=True)
+    return result
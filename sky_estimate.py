@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from task import *
+from fit_result import file_fingerprint
+from profiles import pixel_grid
+
+# radius beyond which a component adds little light: (size parameter, multiple of it)
+OUTER_RADIUS = {'sersic': ('effective_radius', 4.), 'devauc': ('effective_radius', 5.),
+                'expdisk': ('effective_radius', 6.), 'edgedisk': ('scale_length', 6.),
+                'gaussian': ('fwhm', 1.5), 'moffat': ('fwhm', 4.), 'ferrer': ('outer_truncation_radius', 1.),
+                'king': ('tidal_radius', 1.), 'nuker': ('break_radius', 6.)}
+
+
+def component_ellipses(components, factor=1., psf_radius=0.):
+    """
+    Regions dominated by the light of the components, excluded from the sky estimate
+    :param components: list of Component, sky components are skipped
+    :param factor: float, scales every radius of OUTER_RADIUS
+    :param psf_radius: float, radius excluded around psf components [pixels]
+    :return: list of tuple, (x, y, semi-major axis, axis ratio, position angle)
+    """
+    ellipses = []
+    for component in components:
+        type = component.__type__
+        if type == 'psf':
+            x, y = component.position
+            ellipses.append((x, y, factor * psf_radius, 1., 0.))
+        elif type in OUTER_RADIUS:
+            name, multiple = OUTER_RADIUS[type]
+            x, y = component.position
+            if type == 'edgedisk':
+                q = component.scale_height / max(component.scale_length, 1e-8)
+            else:
+                q = component.axis_ratio
+            ellipses.append((x, y, factor * multiple * getattr(component, name), min(max(q, 0.05), 1.),
+                             component.position_angle))
+    return ellipses
+
+
+def outer_region(shape, ellipses, good=None, origin=(1, 1), min_fraction=0.05, border=0.1):
+    """
+    Pixels outside all ellipses; the outer border of the image if they are too few
+    :param ellipses: list of tuple, see component_ellipses
+    :param good: 2D bool array, usable pixels
+    :param min_fraction: float, smallest fraction of the good pixels accepted as outer region
+    :param border: float, width of the fallback border as a fraction of each axis
+    :return: 2D bool array
+    """
+    x, y = pixel_grid(shape, origin)
+    good = np.ones(shape, dtype=bool) if good is None else good
+    outer = good.copy()
+    for x0, y0, a, q, pa in ellipses:
+        theta = np.radians(pa)
+        dx, dy = x - x0, y - y0
+        u = -dx * np.sin(theta) + dy * np.cos(theta)
+        v = -dx * np.cos(theta) - dy * np.sin(theta)
+        outer &= u ** 2 + (v / q) ** 2 > a ** 2
+    if outer.sum() >= max(min_fraction * good.sum(), 3):
+        return outer
+    ny, nx = shape
+    by, bx = max(int(border * ny), 1), max(int(border * nx), 1)
+    frame = np.zeros(shape, dtype=bool)
+    frame[:by], frame[-by:], frame[:, :bx], frame[:, -bx:] = True, True, True, True
+    return good & frame
+
+
+def clipped_plane(data, region, origin=(1, 1), nsigma=3., max_iter=10, gradient=True):
+    """
+    Sigma-clipped least-squares plane, parametrized as the GALFIT sky: background at the centre of the
+    image and gradients per pixel in x and y
+    :param data: 2D array
+    :param region: 2D bool array, pixels used
+    :param nsigma: float, clipping threshold in robust standard deviations of the residual
+    :param max_iter: int, clipping iterations
+    :param gradient: bool, fit the gradients, otherwise they are 0
+    :return: (float, float, float, float), background, gradient_x, gradient_y and the clipped scatter
+    """
+    x, y = pixel_grid(data.shape, origin)
+    xc, yc = (x.min() + x.max()) / 2, (y.min() + y.max()) / 2
+    values = data[region]
+    design = np.column_stack([np.ones(values.size), x[region] - xc, y[region] - yc])
+    if not gradient:
+        design = design[:, :1]
+    keep = np.isfinite(values)
+    coefficients, scatter = np.array([np.nan, 0., 0.]), np.nan
+    for _ in range(max_iter):
+        if keep.sum() < 3:
+            break
+        coefficients = np.zeros(3)
+        coefficients[:design.shape[1]] = np.linalg.lstsq(design[keep], values[keep], rcond=None)[0]
+        residual = values - design @ coefficients[:design.shape[1]]
+        scatter = 1.4826 * np.median(np.abs(residual[keep] - np.median(residual[keep])))
+        clipped = np.isfinite(residual) & (np.abs(residual) <= nsigma * scatter)
+        if np.array_equal(clipped, keep):
+            break
+        keep = clipped
+    return float(coefficients[0]), float(coefficients[1]), float(coefficients[2]), float(scatter)
+
+
+def estimate_sky(task: GalfitTask, factor=1., nsigma=3., max_iter=10, gradient=True):
+    """
+    Sky plane of the fitted region from the pixels outside the light of the task's components and the mask
+    :param factor: float, see component_ellipses
+    :param gradient: bool, fit the gradients, otherwise only the clipped background
+    :return: dict, 'background', 'gradient_x', 'gradient_y', 'scatter' and 'npix'
+    """
+    config = task.config
+    x1, x2, y1, y2 = config.image_region
+    section = (slice(y1 - 1, y2), slice(x1 - 1, x2))
+    data = fits.getdata(config.input_file)[section].astype(float)
+    good = np.isfinite(data)
+    if config.mask_file != 'none':
+        good &= fits.getdata(config.mask_file)[section] == 0
+    ellipses = component_ellipses(task.components, factor, psf_radius=max(config.convolution_size) / 2)
+    region = outer_region(data.shape, ellipses, good, (x1, y1))
+    background, gradient_x, gradient_y, scatter = clipped_plane(data, region, (x1, y1), nsigma, max_iter, gradient)
+    return {'background': background, 'gradient_x': gradient_x, 'gradient_y': gradient_y,
+            'scatter': scatter, 'npix': int(region.sum())}
+
+
+def set_sky(task: GalfitTask, sky):
+    """
+    Put an estimate into the sky components of a task, keeping their fit flags
+    :param sky: dict, as returned by estimate_sky
+    :return: int, number of sky components set
+    """
+    count = 0
+    for component in task.components:
+        if component.__type__ != 'sky' or not np.isfinite(sky['background']):
+            continue
+        component.set_background(sky['background'], component.__background__.trainable)
+        component.set_gradient_x(sky['gradient_x'], component.__gradient_x__.trainable)
+        component.set_gradient_y(sky['gradient_y'], component.__gradient_y__.trainable)
+        count += 1
+    return count
+
+
+class SkyCache:
+    def __init__(self, cache_file=None):
+        """
+        Sky estimates by input file, mask, region and excluded ellipses, invalidated when a file changes
+        :param cache_file: str, json file keeping the estimates between sessions, memory only if None
+        """
+        self.__cache_file__ = cache_file
+        self.__entries__ = {}
+        self.__lock__ = threading.Lock()
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file) as file:
+                self.__entries__ = json.load(file)
+
+    @staticmethod
+    def key(task: GalfitTask, **options):
+        config = task.config
+        files = [os.path.abspath(name) if name != 'none' else name for name in (config.input_file, config.mask_file)]
+        ellipses = [[round(float(v), 3) for v in ellipse] for ellipse in
+                    component_ellipses(task.components, options.get('factor', 1.),
+                                       max(config.convolution_size) / 2)]
+        return json.dumps([files, [file_fingerprint(name) for name in files], config.image_region, ellipses,
+                           sorted(options.items())])
+
+    def get(self, key):
+        with self.__lock__:
+            return self.__entries__.get(key)
+
+    def put(self, key, sky):
+        with self.__lock__:
+            self.__entries__[key] = sky
+
+    def save(self):
+        if self.__cache_file__ is None:
+            return
+        with self.__lock__:
+            with open(self.__cache_file__, 'w') as file:
+                json.dump(self.__entries__, file)
+
+
+def initialize_sky(tasks, max_workers=None, cache=None, **kwargs):
+    """
+    Estimate the sky of many tasks in parallel and set their sky components before the run
+    :param tasks: list of GalfitTask, modified in place
+    :param max_workers: int, number of threads
+    :param cache: SkyCache, or str for a SkyCache file; unchanged inputs are not measured again
+    :param kwargs: passed on to estimate_sky
+    :return: list of dict, the estimates, None where the input could not be read
+    """
+    if isinstance(cache, str):
+        cache = SkyCache(cache)
+
+    def measure(task):
+        key = SkyCache.key(task, **kwargs) if cache is not None else None
+        sky = cache.get(key) if cache is not None else None
+        if sky is None:
+            try:
+                sky = estimate_sky(task, **kwargs)
+            except (OSError, IndexError, KeyError, ValueError):
+                return None
+            if cache is not None:
+                cache.put(key, sky)
+        set_sky(task, sky)
+        return sky
+
+    tasks = list(tasks)
+    with ThreadPoolExecutor(max_workers) as executor:
+        results = list(executor.map(measure, tasks))
+    if cache is not None:
+        cache.save()
+    return results
@@ -0,0 +1,29 @@
+import sqlite3
+
+
+class SQLiteStore:
+    def __init__(self, db_file, schema, timeout=60, isolation_level=''):
+        """
+        Connection to a SQLite file holding one of the stores (jobs, headers, fit logs), rows are sqlite3.Row
+        :param db_file: str, SQLite database file, created if missing
+        :param schema: str, CREATE ... IF NOT EXISTS statements run on opening
+        :param timeout: float, seconds to wait for the database lock
+        :param isolation_level: str, see sqlite3.connect, None for autocommit with explicit transactions
+        """
+        self.__db_file__ = db_file
+        self.__connection__ = sqlite3.connect(db_file, timeout=timeout, isolation_level=isolation_level)
+        self.__connection__.row_factory = sqlite3.Row
+        self.__connection__.executescript(schema)
+
+    @property
+    def db_file(self):
+        return self.__db_file__
+
+    def close(self):
+        self.__connection__.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
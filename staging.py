@@ -0,0 +1,217 @@
+import collections
+import copy
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from task import *
+
+# config parameters holding input files, as (attribute, letter)
+__inputs__ = [('__input__', 'A'), ('__sigma__', 'C'), ('__psf__', 'D'), ('__mask__', 'F'), ('__constrains__', 'G')]
+OUTPUTS = ('output', 'restart', 'log')
+
+
+def default_root():
+    """
+    :return: str, /dev/shm if it is a writable directory, else the system temporary directory
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class Stage:
+    def __init__(self, root=None, copy_workers=4, cache_bytes=2**30):
+        """
+        Local scratch space (tmpfs by default) where GALFIT reads its inputs and writes its outputs
+        Inputs are copied in once and shared by all tasks run through the stage; outputs are copied back
+        in background threads. Use it as a context manager, or call close, to wait for the copies.
+        A staged input is kept while a running task uses it; unused inputs are kept for later tasks up to
+        cache_bytes, least recently used first out, since tmpfs is node memory.
+        :param root: str, parent of the scratch directory, see default_root
+        :param copy_workers: int, number of threads copying outputs back
+        :param cache_bytes: int, size of the unused staged inputs kept [bytes], 0 to remove them at once
+        """
+        self.__dir__ = tempfile.mkdtemp(prefix='galfit-stage-', dir=root or default_root())
+        os.makedirs(os.path.join(self.__dir__, 'inputs'))
+        self.cache_bytes = cache_bytes
+        # (path, mtime, size) -> dict with the staged path, ready event and number of users, in LRU order
+        self.__staged__ = collections.OrderedDict()
+        self.__keys__ = {}
+        self.__unused_bytes__ = 0
+        self.__lock__ = threading.Lock()
+        self.__executor__ = ThreadPoolExecutor(copy_workers)
+
+    @property
+    def dir(self):
+        return self.__dir__
+
+    @property
+    def staged_bytes(self):
+        """
+        :return: int, size of the staged inputs [bytes]
+        """
+        with self.__lock__:
+            return sum(entry['size'] for entry in self.__staged__.values())
+
+    def close(self):
+        self.__executor__.shutdown(wait=True)
+        shutil.rmtree(self.__dir__, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def stage_input(self, file_name):
+        """
+        Copy an input file into the stage, once per file version (path, mtime, size), and hold it
+        Every call must be matched by release_input once the staged file is no longer read.
+        :return: str, staged path; 'none' is returned as is
+        """
+        if file_name == 'none':
+            return file_name
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self.__lock__:
+            entry = self.__staged__.get(key)
+            if entry is None:
+                name = hashlib.sha1(repr(key).encode()).hexdigest()[:12] + '_' + os.path.basename(path)
+                entry = {'path': os.path.join(self.__dir__, 'inputs', name), 'ready': threading.Event(),
+                         'users': 0, 'size': stat.st_size}
+                self.__staged__[key] = entry
+                self.__keys__[entry['path']] = key
+                owner = True
+            else:
+                owner = False
+                self.__staged__.move_to_end(key)
+                if entry['users'] == 0:
+                    self.__unused_bytes__ -= entry['size']
+            entry['users'] += 1
+        staged = entry['path']
+        if owner:
+            # copy outside the lock, other tasks needing the same file wait for the event
+            try:
+                shutil.copyfile(path, staged + '.part')
+                os.replace(staged + '.part', staged)
+            except BaseException:
+                with self.__lock__:
+                    self.__staged__.pop(key, None)
+                    self.__keys__.pop(staged, None)
+                raise
+            finally:
+                entry['ready'].set()
+        else:
+            entry['ready'].wait()
+        if not os.path.exists(staged):
+            raise OSError(f'Staging {path} failed')
+        return staged
+
+    def release_input(self, staged):
+        """
+        Drop a hold taken by stage_input; unused inputs beyond cache_bytes are removed
+        :param staged: str, staged path returned by stage_input
+        """
+        evicted = []
+        with self.__lock__:
+            key = self.__keys__.get(staged)
+            entry = self.__staged__.get(key)
+            if entry is None or entry['users'] == 0:
+                return
+            entry['users'] -= 1
+            if entry['users'] == 0:
+                self.__unused_bytes__ += entry['size']
+            for key in list(self.__staged__):
+                if self.__unused_bytes__ <= self.cache_bytes:
+                    break
+                entry = self.__staged__[key]
+                if entry['users'] == 0:
+                    del self.__staged__[key]
+                    del self.__keys__[entry['path']]
+                    self.__unused_bytes__ -= entry['size']
+                    evicted.append(entry['path'])
+        for path in evicted:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def run(self, task: GalfitTask, galfit_file=None, galfit_mode=0, options=(), outputs=OUTPUTS):
+        """
+        Run GALFIT on the staged inputs in a private directory of the stage
+        :param task: GalfitTask, not modified
+        :param galfit_file: str, parameter file of the task, see GalfitTask.run; the restart file and the log
+                            are copied back to galfit_file + '.01' and galfit_file + '.log'
+        :param outputs: iterable of 'output', 'restart', 'log', the files copied back
+        :return: concurrent.futures.Future, done when the outputs are back, its result is the list of files;
+                 its rusage attribute is the resource usage of GALFIT, see run_galfit
+        """
+        config = task.config
+        if galfit_file is None:
+            galfit_file = config.output_file.replace('.fits', '.galfit')
+        originals = {}
+        staged_task = copy.deepcopy(task)
+        held, cwd = [], None
+        try:
+            for attr, _ in __inputs__:
+                parameter = getattr(staged_task.config, attr)
+                original = parameter.value
+                parameter.value = self.stage_input(original)
+                if original != 'none':
+                    held.append(parameter.value)
+                    originals[parameter.value] = os.path.abspath(original)
+            cwd = tempfile.mkdtemp(dir=self.__dir__)
+            staged_output = os.path.join(cwd, os.path.basename(config.output_file))
+            staged_task.config.output_file = staged_output
+            staged_galfit = os.path.join(cwd, os.path.basename(galfit_file))
+            usage = staged_task.run(staged_galfit, galfit_mode=galfit_mode, options=options, cwd=cwd)
+        except BaseException:
+            if cwd is not None:
+                shutil.rmtree(cwd, ignore_errors=True)
+            raise
+        finally:
+            # the inputs are read by GALFIT only, the copy back does not need them
+            for staged in held:
+                self.release_input(staged)
+        originals[staged_output] = os.path.abspath(config.output_file)
+        copies = {'output': (staged_output, config.output_file),
+                  'restart': (os.path.join(cwd, 'galfit.01'), galfit_file + '.01'),
+                  'log': (os.path.join(cwd, 'fit.log'), galfit_file + '.log')}
+        future = self.__executor__.submit(self.__copy_back__, cwd, [(o, *copies[o]) for o in outputs], originals)
+        future.rusage = usage
+        return future
+
+    def __copy_back__(self, cwd, copies, originals):
+        try:
+            copied = []
+            for name, source, destination in copies:
+                if not os.path.exists(source):
+                    continue
+                if name == 'output':
+                    # GALFIT writes the staged paths into the headers (DATAIN, PSF, MASK, SIGMA, ...)
+                    with fits.open(source, mode='update') as hdul:
+                        for hdu in hdul:
+                            for i, value in enumerate(list(hdu.header.values())):
+                                if isinstance(value, str) and any(staged in value for staged in originals):
+                                    for staged, original in originals.items():
+                                        value = value.replace(staged, original)
+                                    hdu.header[i] = value
+                    shutil.copyfile(source, destination)
+                elif name == 'restart':
+                    # the restart file names the staged files, point it back to the originals
+                    with open(source) as file:
+                        text = file.read()
+                    for staged, original in originals.items():
+                        text = text.replace(staged, original)
+                    with open(destination, 'w') as file:
+                        file.write(text)
+                else:
+                    shutil.copyfile(source, destination)
+                copied.append(destination)
+            return copied
+        finally:
+            shutil.rmtree(cwd, ignore_errors=True)
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+from task import *
+from lazy_import import LazyModule
+from profiles import model_image
+from psf_library import load_stamp
+
+signal = LazyModule('scipy.signal')
+
+
+def load_psf(psf_file):
+    """
+    :param psf_file: str, PSF image, 'none' for no PSF
+    :return: read-only 2D array normalized to unit sum, shared through the stamp cache, None without a PSF
+    """
+    if psf_file == 'none':
+        return None
+    return load_stamp(psf_file)
+
+
+def point_source(component, shape, zeropoint=0, origin=(1, 1)):
+    """
+    Unconvolved PSF component: its flux split bilinearly over the four pixels around the position
+    :return: 2D array, zero if the position is outside the image
+    """
+    image = np.zeros(shape)
+    x, y = component.position
+    col, row = x - origin[0], y - origin[1]
+    i, j = int(np.floor(row)), int(np.floor(col))
+    fy, fx = row - i, col - j
+    flux = 10 ** (-0.4 * (component.magnitude - zeropoint))
+    for di, wy in ((0, 1 - fy), (1, fy)):
+        for dj, wx in ((0, 1 - fx), (1, fx)):
+            if 0 <= i + di < shape[0] and 0 <= j + dj < shape[1]:
+                image[i + di, j + dj] += flux * wx * wy
+    return image
+
+
+def component_image(component, shape, zeropoint=0, pixel_scale=1, origin=(1, 1), psf=None):
+    """
+    Image of one component in the fitted region
+    :param psf: 2D array normalized to unit sum, None for the unconvolved image; the sky is never convolved
+    :return: 2D array
+    """
+    if component.__type__ == 'psf':
+        image = point_source(component, shape, zeropoint, origin)
+    else:
+        image = model_image(component, shape, zeropoint, pixel_scale, origin)
+    if psf is None or component.__type__ == 'sky':
+        return image
+    return signal.fftconvolve(image, psf, mode='same')
+
+
+def write_subcomps(task: GalfitTask, subcomps_file=None, convolve=True):
+    """
+    Write the subcomponent cube GALFIT makes in mode 3 (-o3) from the component parameters,
+    without running GALFIT again: primary HDU is the input image in the fitted region,
+    then one image HDU per component with OBJECT set to the component type
+    Read the fitted parameters into the task first (GalfitTask.read_component on galfit.01).
+    :param task: GalfitTask
+    :param subcomps_file: str, 'subcomps.fits' next to the output file by default
+    :param convolve: bool, convolve the components with the PSF of the config
+    :return: str, the file written
+    """
+    config = task.config
+    x1, x2, y1, y2 = config.image_region
+    shape = (y2 - y1 + 1, x2 - x1 + 1)
+    pixel_scale = config.pixel_scale
+    psf = load_psf(config.psf_file) if convolve else None
+    if subcomps_file is None:
+        subcomps_file = os.path.join(os.path.dirname(config.output_file), 'subcomps.fits')
+    data = fits.getdata(config.input_file)[y1-1:y2, x1-1:x2]
+    header = fits.Header()
+    header['FITSECT'] = f'[{x1}:{x2},{y1}:{y2}]'
+    hdus = [fits.PrimaryHDU(data, header=header)]
+    for component in task.components:
+        image = component_image(component, shape, config.zeropoint, pixel_scale, (x1, y1), psf)
+        hdu = fits.ImageHDU(image.astype(np.float32))
+        hdu.header['OBJECT'] = component.__type__
+        hdu.header['FITSECT'] = f'[{x1}:{x2},{y1}:{y2}]'
+        hdus.append(hdu)
+    fits.HDUList(hdus).writeto(subcomps_file, overwrite=True)
+    return subcomps_file
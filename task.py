@@ -1,50 +1,89 @@
 from components import *
-from astropy.io import fits
+from lazy_import import LazyModule
+import io
+import os
+import json
 import subprocess
 
+fits = LazyModule('astropy.io.fits')
+
+__config_parameters__ = [('__input__', 'A'), ('__output__', 'B'), ('__sigma__', 'C'), ('__psf__', 'D'),
+                         ('__psf_scale__', 'E'), ('__mask__', 'F'), ('__constrains__', 'G'),
+                         ('__image_region__', 'H'), ('__convolution_size__', 'I'), ('__zeropoint__', 'J'),
+                         ('__pixel_scale__', 'K'), ('__Display_type__', 'O'), ('__mode__', 'P')]
+
+
+def read_header(header, key):
+    """
+    Header value, falling back to the underscore-prefixed name (ZPT_GSC -> _PT_GSC)
+    """
+    if key in header:
+        return header[key]
+    else:
+        return header['_'+key[1:]]
+
+
+def header_config(input_file, input_header, psf_file, psf_header, output_file=None,
+                  sigma_file='none', mask_file='none'):
+    """
+    Config parameters of an image and its PSF from their primary headers
+    :param input_header, psf_header: header or dict with NAXIS1, NAXIS2, ZPT_GSC, CD1_1, CD1_2, CD2_1, CD2_2
+                                     (input) and NAXIS1, NAXIS2, SCALE (PSF)
+    :return: dict, parameter letter -> value, see Config.from_dict
+    """
+    if output_file is None:
+        output_file = input_file.replace('.fit', '_out.fits')
+    in_s1 = read_header(input_header, 'NAXIS1')
+    in_s2 = read_header(input_header, 'NAXIS2')
+    psf_s1 = read_header(psf_header, 'NAXIS1')
+    psf_s2 = read_header(psf_header, 'NAXIS2')
+    cd11 = read_header(input_header, 'CD1_1')
+    cd12 = read_header(input_header, 'CD1_2')
+    cd21 = read_header(input_header, 'CD2_1')
+    cd22 = read_header(input_header, 'CD2_2')
+    dx = np.sqrt(cd11**2+cd12**2)
+    dy = np.sqrt(cd21**2+cd22**2)
+    return {'A': input_file, 'B': output_file, 'C': sigma_file, 'D': psf_file,
+            'E': read_header(psf_header, 'SCALE'), 'F': mask_file, 'G': 'none',
+            'H': f"1 {in_s1} 1 {in_s2}", 'I': f"{psf_s1} {psf_s2}",
+            'J': read_header(input_header, 'ZPT_GSC'), 'K': f"{dx} {dy}", 'O': 'regular', 'P': 0}
+
 
 class Config:
     def __init__(self, input_file, output_file=None, psf_file='none', sigma_file='none', mask_file='none'):
-        self.__input__ = StrParam('A', input_file)
-        if output_file is None:
-            output_file = input_file.replace('.fit', '_out.fits')
-        self.__output__ = StrParam('B', output_file)
-        self.__psf__ = StrParam('D', psf_file)
-        self.__sigma__ = StrParam('C', sigma_file)
-        self.__mask__ = StrParam('F', mask_file)
-        self.__mode__ = StrParam('P', 0)
-        input_file = fits.open(self.__input__.value)
-        psf_file = fits.open(self.__psf__.value)
-        scale = self.__read_header__(psf_file[0], 'SCALE')
-        self.__psf_scale__ = StrParam('E', scale)
-        self.__constrains__ = StrParam('G', 'none')
-        in_s1 = self.__read_header__(input_file[0], 'NAXIS1')
-        in_s2 = self.__read_header__(input_file[0], 'NAXIS2')
-        self.__image_region__ = StrParam('H', f"1 {in_s1} 1 {in_s2}")
-        psf_s1 = self.__read_header__(psf_file[0], 'NAXIS1')
-        psf_s2 = self.__read_header__(psf_file[0], 'NAXIS2')
-        self.__convolution_size__ = StrParam('I', f"{psf_s1} {psf_s2}")
-        zp = self.__read_header__(input_file[0], 'ZPT_GSC')
-        self.__zeropoint__ = StrParam('J', zp)
-        cd11 = self.__read_header__(input_file[0], 'CD1_1')
-        cd12 = self.__read_header__(input_file[0], 'CD1_2')
-        cd21 = self.__read_header__(input_file[0], 'CD2_1')
-        cd22 = self.__read_header__(input_file[0], 'CD2_2')
-        dx = np.sqrt(cd11**2+cd12**2)
-        dy = np.sqrt(cd21**2+cd22**2)
-        self.__pixel_scale__ = StrParam('K', f"{dx} {dy}")
-        self.__Display_type__ = StrParam('O', 'regular')
-        input_file.close()
-        psf_file.close()
-        self.parameters = [self.__input__, self.__output__, self.__sigma__, self.__psf__,
-                           self.__psf_scale__, self.__mask__, self.__constrains__, self.__image_region__,
-                           self.__convolution_size__, self.__zeropoint__, self.__pixel_scale__, self.__Display_type__, self.__mode__]
+        with fits.open(input_file) as input_hdul, fits.open(psf_file) as psf_hdul:
+            d = header_config(input_file, input_hdul[0].header, psf_file, psf_hdul[0].header,
+                              output_file, sigma_file, mask_file)
+        self.__setstate__([d[num] for _, num in __config_parameters__])
+
+    def __getstate__(self):
+        return [param.value for param in self.parameters]
+
+    def __setstate__(self, state):
+        for (attr, num), value in zip(__config_parameters__, state):
+            setattr(self, attr, StrParam(num, value))
+        self.parameters = [getattr(self, attr) for attr, _ in __config_parameters__]
+
+    def to_dict(self):
+        """
+        Plain python representation, suitable for json or msgpack
+        :return: dict, parameter letter -> value
+        """
+        return {num: value for (_, num), value in zip(__config_parameters__, self.__getstate__())}
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Rebuild a config written by to_dict, no FITS file is opened
+        :param d: dict, parameter letter -> value
+        :return: Config
+        """
+        config = cls.__new__(cls)
+        config.__setstate__([d[num] for _, num in __config_parameters__])
+        return config
 
     def __read_header__(self, hdu, key):
-        if key in hdu.header:
-            return hdu.header[key]
-        else:
-            return hdu.header['_'+key[1:]]
+        return read_header(hdu.header, key)
 
     @property
     def galfit_mode(self):
@@ -55,10 +94,84 @@ class Config:
         self.__mode__.value = mode
 
     @property
-    def pixel_scale(self):
+    def input_file(self):
+        return self.__input__.value
+
+    @property
+    def output_file(self):
+        return self.__output__.value
+
+    @property
+    def psf_file(self):
+        return self.__psf__.value
+
+    @property
+    def sigma_file(self):
+        return self.__sigma__.value
+
+    @property
+    def mask_file(self):
+        return self.__mask__.value
+
+    @input_file.setter
+    def input_file(self, input_file: str):
+        self.__input__.value = input_file
+
+    @output_file.setter
+    def output_file(self, output_file: str):
+        self.__output__.value = output_file
+
+    @psf_file.setter
+    def psf_file(self, psf_file: str):
+        self.__psf__.value = psf_file
+
+    @sigma_file.setter
+    def sigma_file(self, sigma_file: str):
+        self.__sigma__.value = sigma_file
+
+    @mask_file.setter
+    def mask_file(self, mask_file: str):
+        self.__mask__.value = mask_file
+
+    def abspath(self):
+        """
+        Turn the input, output, sigma, psf and mask paths into absolute paths,
+        needed when GALFIT runs in another working directory
+        """
+        for param in [self.__input__, self.__output__, self.__sigma__, self.__psf__, self.__mask__]:
+            if param.value != 'none':
+                param.value = os.path.abspath(param.value)
+
+    @property
+    def image_region(self):
+        value = re.split(r'\s+', str(self.__image_region__.value).strip())
+        return tuple(int(float(v)) for v in value[:4])
+
+    @image_region.setter
+    def image_region(self, region: tuple):
+        self.__image_region__.value = ' '.join(str(int(v)) for v in region)
+
+    @property
+    def convolution_size(self):
+        value = re.split(r'\s+', str(self.__convolution_size__.value).strip())
+        return tuple(int(float(v)) for v in value[:2])
+
+    @convolution_size.setter
+    def convolution_size(self, size: tuple):
+        self.__convolution_size__.value = ' '.join(str(int(v)) for v in size)
+
+    @property
+    def pixel_size(self):
         value = re.split(r'\s+', self.__pixel_scale__.value)
-        dx, dy = float(value[0]), float(value[1])
-        return np.sqrt(dx**2+dy**2) * 3600
+        return float(value[0]) * 3600, float(value[1]) * 3600
+
+    @property
+    def pixel_scale(self):
+        """
+        Pixel size [arcsec], geometric mean of the two axes (the side of a square pixel)
+        """
+        dx, dy = self.pixel_size
+        return np.sqrt(dx * dy)
 
     @property
     def zeropoint(self):
@@ -69,10 +182,14 @@ class Config:
         return value
 
     def __repr__(self) -> str:
-        s = ''
-        for param in self.parameters:
-            s += param.__repr__() + '\n'
-        return s
+        return ''.join([f"{param!r}\n" for param in self.parameters])
+
+    def write(self, file):
+        """
+        Write the control parameters of the parameter file
+        :param file: text file handle
+        """
+        file.write(self.__repr__())
 
 
 class GalfitTask:
@@ -95,10 +212,47 @@ class GalfitTask:
         self.__components__.pop(index)
 
     def __repr__(self) -> str:
-        s = self.__config__.__repr__() + '\n'
+        buffer = io.StringIO()
+        self.write(buffer)
+        return buffer.getvalue()
+
+    def write(self, file):
+        """
+        Stream the parameter file, component by component, without building it in memory
+        :param file: text file handle
+        """
+        self.__config__.write(file)
+        file.write('\n')
         for component in self.__components__:
-            s += component.__repr__() + '\n'
-        return s
+            component.write(file)
+            file.write('\n')
+
+    def to_dict(self):
+        """
+        Plain python representation, suitable for json or msgpack
+        :return: dict, {'config': dict, 'components': [dict, ...]}
+        """
+        return {'config': self.__config__.to_dict(),
+                'components': [component.to_dict() for component in self.__components__]}
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Rebuild a task written by to_dict, no FITS file is opened
+        :param d: dict
+        :return: GalfitTask
+        """
+        task = cls(Config.from_dict(d['config']))
+        for component in d['components']:
+            task.add_component(Component.from_dict(component))
+        return task
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, s: str):
+        return cls.from_dict(json.loads(s))
 
     def read_component(self, file_name):
         self.__components__ = []
@@ -109,17 +263,55 @@ class GalfitTask:
                 pos = line.find(')')
                 if len(line) > 0 and pos > 0:
                     if line[0] == '0':
-                        line = line.split(' ')
+                        line = line.split()
                         component = component_names[line[1]]()
                         file = component.read(file)
                         self.__components__.append(component)
                 line = file.readline()
 
-    def run(self, galfit_file=None, galfit_mode=0):
+    def run(self, galfit_file=None, galfit_mode=0, options=(), cwd=None, stage=None):
+        # stage: staging.Stage, run on local copies of the inputs, see Stage.run (cwd is then ignored)
+        # returns the resource usage of GALFIT, see run_galfit, or the Future of Stage.run
+        if stage is not None:
+            return stage.run(self, galfit_file, galfit_mode=galfit_mode, options=options)
         if galfit_file is None:
             galfit_file = self.__config__.__output__.value.replace(
                 '.fits', '.galfit')
         self.config.galfit_mode = galfit_mode
-        with open(galfit_file, 'w') as file:
-            print(self, file=file)
-        subprocess.run(['galfit', galfit_file], check=True)
+        with open(galfit_file, 'w', buffering=1 << 20) as file:
+            self.write(file)
+        return run_galfit(galfit_file, options=options, cwd=cwd)
+
+
+def read_chi2nu(output_file):
+    """
+    Reduced chi2 of a GALFIT output, from the CHI2NU keyword of the model HDU
+    :param output_file: str, GALFIT output cube
+    :return: float
+    """
+    return float(fits.getheader(output_file, 2)['CHI2NU'])
+
+
+def run_galfit(galfit_file, options=(), cwd=None):
+    """
+    Run GALFIT on an existing parameter file
+    :param galfit_file: str, parameter file
+    :param options: iterable of str, extra command line options, e.g. ('-imax', '20')
+    :param cwd: str, working directory receiving fit.log and galfit.NN, defaults to the current one
+    :return: resource.struct_rusage of the GALFIT process, e.g. ru_maxrss for its peak memory
+    """
+    if cwd is not None:
+        galfit_file = os.path.abspath(galfit_file)
+    command = ['galfit', *options, galfit_file]
+    process = subprocess.Popen(command, cwd=cwd)
+    try:
+        # wait4 instead of wait, for the resource usage of this child only
+        _, status, usage = os.wait4(process.pid, 0)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return usage
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from components import component_names
+from profiles import __parameter_names__, model_jacobian, numerical_jacobian, set_parameter
+
+# off-centre positions and non-default shapes, so every partial derivative is exercised
+PARAMETERS = {
+    'sersic': dict(magnitude=15, effective_radius=6, sersic_index=2.3, axis_ratio=0.6, position_angle=30),
+    'devauc': dict(magnitude=15, effective_radius=6, axis_ratio=0.6, position_angle=-40),
+    'expdisk': dict(magnitude=15, effective_radius=6, axis_ratio=0.6, position_angle=30),
+    'gaussian': dict(magnitude=15, fwhm=6, axis_ratio=0.6, position_angle=30),
+    'moffat': dict(magnitude=15, fwhm=6, power_law=2.5, axis_ratio=0.6, position_angle=30),
+    'ferrer': dict(central_surface_brightness=18, outer_truncation_radius=12, alpha=2.2, beta=0.5,
+                   axis_ratio=0.6, position_angle=30),
+    'nuker': dict(surface_brightness=18, break_radius=5, alpha=2, beta=1.5, gamma=0.5,
+                  axis_ratio=0.6, position_angle=30),
+    'king': dict(central_surface_brightness=18, core_radius=3, tidal_radius=15, alpha=2.7,
+                 axis_ratio=0.6, position_angle=30),
+    'edgedisk': dict(central_surface_brightness=18, scale_height=2, scale_length=7, position_angle=30),
+    'sky': dict(background=3, gradient_x=0.01, gradient_y=-0.02),
+}
+
+
+def make_component(type):
+    component = component_names[type]()
+    if type != 'sky':
+        set_parameter(component, 'x', 20.3)
+        set_parameter(component, 'y', 18.7)
+    for name, value in PARAMETERS[type].items():
+        set_parameter(component, name, value)
+    return component
+
+
+@pytest.mark.parametrize('type', [type for type in __parameter_names__ if type != 'psf'])
+def test_jacobian_matches_finite_differences(type):
+    component = make_component(type)
+    _, analytic = model_jacobian(component, (40, 42), zeropoint=25, pixel_scale=0.4)
+    numeric = numerical_jacobian(component, (40, 42), zeropoint=25, pixel_scale=0.4)
+    assert set(analytic) == set(numeric)
+    for name in numeric:
+        scale = np.abs(numeric[name]).max() + 1e-30
+        assert np.abs(analytic[name] - numeric[name]).max() / scale < 1e-4, name
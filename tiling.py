@@ -0,0 +1,171 @@
+import copy
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from task import *
+
+
+def make_tiles(region, tile_size, overlap):
+    """
+    Split an image region into tiles
+    :param region: tuple, (x1, x2, y1, y2) in GALFIT pixels, both ends included
+    :param tile_size: int, side of the tile cores [pixels]
+    :param overlap: int, border added around every core [pixels]
+    :return: list of (core, outer) regions; the cores partition the region,
+             the outer regions are the cores grown by overlap and clipped to the region
+    """
+    x1, x2, y1, y2 = region
+    tiles = []
+    for ty in range(y1, y2 + 1, tile_size):
+        for tx in range(x1, x2 + 1, tile_size):
+            core = (tx, min(tx + tile_size - 1, x2), ty, min(ty + tile_size - 1, y2))
+            outer = (max(core[0] - overlap, x1), min(core[1] + overlap, x2),
+                     max(core[2] - overlap, y1), min(core[3] + overlap, y2))
+            tiles.append((core, outer))
+    return tiles
+
+
+def _inside(position, region):
+    # pixel i covers [i - 0.5, i + 0.5)
+    x, y = position
+    return region[0] - 0.5 <= x < region[1] + 0.5 and region[2] - 0.5 <= y < region[3] + 0.5
+
+
+def freeze(component):
+    """
+    Fix every parameter of a component
+    """
+    for parameter in component.__parameters__:
+        if isinstance(parameter, StrParam):
+            continue
+        parameter.trainable = (False, False) if isinstance(parameter, DoubleParam) else False
+
+
+class TiledTask:
+    def __init__(self, task: GalfitTask, tile_size=512, overlap=32, dedup_radius=1.):
+        """
+        Fit a crowded field as overlapping tiles, each tile a normal GalfitTask on a sub-region
+        Components are assigned to the tile whose core holds their starting position and fitted there;
+        components in the border of a tile are copied into it with all parameters fixed.
+        Components without a position (sky) are fitted independently in every tile.
+        :param task: GalfitTask, the whole field; it is not modified
+        :param tile_size: int, side of the tile cores [pixels]
+        :param overlap: int, width of the fixed border [pixels], about the PSF radius
+        :param dedup_radius: float, components of the same type closer than this after the fit are
+                             merged into the brightest one [pixels]
+        """
+        self.__task__ = copy.deepcopy(task)
+        self.__task__.config.abspath()
+        self.__dedup_radius__ = dedup_radius
+        self.__tiles__ = make_tiles(self.__task__.config.image_region, tile_size, overlap)
+        self.__owners__ = []
+        for component in self.__task__.components:
+            if hasattr(component, 'position'):
+                owner = [k for k, (core, _) in enumerate(self.__tiles__) if _inside(component.position, core)]
+                self.__owners__.append(owner[0] if owner else None)
+            else:
+                self.__owners__.append(-1)
+
+    @property
+    def tiles(self):
+        return self.__tiles__
+
+    def tile_task(self, k, work_dir):
+        """
+        Build the GalfitTask of tile k
+        :return: (GalfitTask, list of int), the task and, for each of its components, the index of the
+                 component in the whole-field task if the tile owns it, else None
+        """
+        core, outer = self.__tiles__[k]
+        config = copy.deepcopy(self.__task__.config)
+        config.image_region = outer
+        config.output_file = os.path.join(work_dir, f'tile{k:05d}_out.fits')
+        task = GalfitTask(config)
+        owned = []
+        for i, (component, owner) in enumerate(zip(self.__task__.components, self.__owners__)):
+            if owner == k or owner == -1:
+                task.add_component(copy.deepcopy(component))
+                owned.append(i)
+            elif owner is not None and _inside(component.position, outer):
+                component = copy.deepcopy(component)
+                freeze(component)
+                task.add_component(component)
+                owned.append(None)
+        return task, owned
+
+    def __fit_tile__(self, k, work_dir):
+        task, owned = self.tile_task(k, work_dir)
+        cwd = os.path.join(work_dir, f'tile{k:05d}')
+        os.makedirs(cwd, exist_ok=True)
+        if not any(i is not None and self.__owners__[i] != -1 for i in owned):
+            return [], []
+        try:
+            task.run(os.path.join(work_dir, f'tile{k:05d}.galfit'), cwd=cwd)
+            task.read_component(os.path.join(cwd, 'galfit.01'))
+        except (subprocess.CalledProcessError, OSError):
+            # keep the starting values of a failed tile
+            pass
+        return [c for c, i in zip(task.components, owned) if i is not None], [i for i in owned if i is not None]
+
+    def run(self, max_workers=None, work_dir=None):
+        """
+        Fit all tiles in parallel and merge them
+        :param max_workers: int, number of GALFIT processes, the number of cores by default
+        :param work_dir: str, directory for the tile files, a temporary directory if None
+        :return: GalfitTask, whole-field task with the merged, de-duplicated components
+        """
+        with tempfile.TemporaryDirectory(dir=work_dir) as tmp, ThreadPoolExecutor(max_workers) as executor:
+            results = list(executor.map(lambda k: self.__fit_tile__(k, tmp), range(len(self.__tiles__))))
+        return self.merge(results)
+
+    def merge(self, results):
+        """
+        :param results: list of (components, indices) per tile, indices into the whole-field task
+        :return: GalfitTask
+        """
+        fitted = [copy.deepcopy(c) for c in self.__task__.components]
+        shared = {}
+        for components, indices in results:
+            for component, i in zip(components, indices):
+                if self.__owners__[i] == -1:
+                    shared.setdefault(i, []).append(component)
+                else:
+                    fitted[i] = component
+        # components without a position take the median over the tiles
+        for i, copies in shared.items():
+            for parameter, values in zip(fitted[i].__parameters__, zip(*(c.__parameters__ for c in copies))):
+                if not isinstance(parameter, StrParam):
+                    parameter.value = float(np.median([p.value for p in values]))
+        task = GalfitTask(copy.deepcopy(self.__task__.config))
+        for component in self.deduplicate(fitted):
+            task.add_component(component)
+        return task
+
+    def deduplicate(self, components):
+        """
+        Drop components that converged onto the same source, keeping the brightest
+        """
+        keep = [True] * len(components)
+        positioned = [i for i, c in enumerate(components) if hasattr(c, 'position')]
+        if len(positioned) > 1 and self.__dedup_radius__ > 0:
+            xy = np.array([components[i].position for i in positioned], dtype=float)
+            order = np.argsort([getattr(components[i], 'magnitude', 0.) for i in positioned], kind='stable')
+            cell = {}
+            # grid hashing: only neighbouring cells are compared
+            for j in order:
+                key = tuple(np.floor(xy[j] / self.__dedup_radius__).astype(int))
+                i = positioned[j]
+                duplicate = False
+                for dx in (-1, 0, 1):
+                    for dy in (-1, 0, 1):
+                        for other in cell.get((key[0] + dx, key[1] + dy), []):
+                            if components[positioned[other]].__type__ == components[i].__type__ and \
+                                    np.hypot(*(xy[j] - xy[other])) < self.__dedup_radius__:
+                                duplicate = True
+                if duplicate:
+                    keep[i] = False
+                else:
+                    cell.setdefault(key, []).append(j)
+        return [c for c, k in zip(components, keep) if k]